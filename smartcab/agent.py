@@ -1,29 +1,49 @@
+import os
 import random
-import operator
-import pandas as pd
+import numpy as np
 import time
 import datetime
 from environment import Agent, Environment
 from planner import RoutePlanner
 from simulator import Simulator
+from eventlog import log, INFO
+from recorder import TrialStatsRecorder, StreamingTrialWriter
+from results_store import ResultsStore
 
 class LearningAgent(Agent):
     """An agent that learns to drive in the smartcab world."""
 
+    trial_stats_columns = ['total_reward', 'negative_reward', 'trial_length', 'reached_destination']
+    actions = ['forward', 'right', 'left', None]
+    action_index = {a: i for i, a in enumerate(actions)}
+    light_index = {'green': 0, 'red': 1}
+    desired_direction_index = {'forward': 0, 'right': 1, 'left': 2}
+
     def __init__(self, env):
         super(LearningAgent, self).__init__(env)  # sets self.env = env, state = None, next_waypoint = None, and a default color
         self.color = 'red'  # override color
         self.planner = RoutePlanner(self.env, self)  # simple route planner to get next_waypoint
         # Initialize any additional variables here
-        self.q_states = {}
-        self.n_states = {}
         self.alpha = 0.5
         self.gamma = 0.5
         self.epsilon = 0.5
-        self.trial_stats_columns = ['total_reward', 'negative_reward', 'trial_length', 'reached_destination']
-        self.trial_stats = pd.DataFrame(columns=self.trial_stats_columns)
-        self.actions = ['forward', 'right', 'left', None]
+        self.trial_stats = TrialStatsRecorder(self.trial_stats_columns, [float, float, int, bool], series=['reward'])
+        self.record_step_rewards = False  # also keep every step's reward in trial_stats
+        self.n_trials = 100  # the data is reported once this many trials have been completed
+        self.trials_completed = 0
+        self.results_writer = None  # optional StreamingTrialWriter for trial_stats
+        self.file_timestamp = None
+        self.output_dir = './data'
+        self.run_id = None  # included in file names when set, e.g. the run's seed
+        self.seed = None
+        self.results_store = None  # optional ResultsStore that the data is reported to instead of files
+        self.store_run_id = None  # the run's id in the results store, once reported
+        self.checkpoint_every = None  # when set, a checkpoint is saved every this many trials
+        self.checkpoint_due = False  # a checkpoint is saved once the current step's learning is done
         self.possible_states = self.state_permutations()
+        # Q(s,a) and N(s,a), indexed by state_index(s) and action_index[a]
+        self.q_table = np.zeros((len(self.possible_states), len(self.actions)))
+        self.n_table = np.zeros((len(self.possible_states), len(self.actions)), dtype=int)
         self.verbose_debugging = False
 
     def reset(self, destination=None):
@@ -54,11 +74,7 @@ class LearningAgent(Agent):
         reward = self.env.act(self, action)
 
         # Update the trial statistics
-        self.total_reward += reward
-        if reward < 0: self.negative_reward += reward
-        self.trial_length += 1
-        self.reached_destination = reward > 2
-        if self.reached_destination or deadline == 0: self.save_trial_stats()
+        self.record_reward(reward, deadline)
 
         # Learn policy based on state, action, reward
         if self.prev_state != None:
@@ -70,22 +86,33 @@ class LearningAgent(Agent):
                 + self.alpha * (self.prev_reward + self.gamma * self.Q_max(self.state)))
             self.Q_set(self.prev_state, self.prev_action, new_q_val)
 
-            self.verbose_output("Previous State: {}".format(self.state_string(self.prev_state)))
-            self.verbose_output("Previous Action: {}".format(self.prev_action))
-            self.verbose_output("Q(s,a):")
-            self.verbose_output(self.state_action_matrix_string(self.Q_get))
-            self.verbose_output("N(s,a):")
-            self.verbose_output(self.state_action_matrix_string(self.N_get))
+            self.verbose_output("Previous State: {}", lambda: self.state_string(self.prev_state))
+            self.verbose_output("Previous Action: {}", self.prev_action)
+            self.verbose_output("Q(s,a):\n{}", lambda: self.state_action_matrix_string(self.Q_get))
+            self.verbose_output("N(s,a):\n{}", lambda: self.state_action_matrix_string(self.N_get))
 
         self.prev_state = self.state.copy()
         self.prev_action = action
         self.prev_reward = reward
 
-        trial_status = "LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}".format(
+        # The trial has ended and its last transition is discarded by reset, so nothing is left to learn
+        if self.checkpoint_due:
+            self.checkpoint_due = False
+            self.save_checkpoint(self.file_name('checkpoint', 'npz'))
+
+        self.verbose_output("LearningAgent.update(): deadline = {}, inputs = {}, action = {}, reward = {}",
             deadline, inputs, action, reward)
-        self.verbose_output(trial_status)
 
 
+    def record_reward(self, reward, deadline):
+        """Adds a step's reward to the trial statistics, which are saved when the trial ends."""
+        if self.record_step_rewards: self.trial_stats.record_step('reward', reward)
+        self.total_reward += reward
+        if reward < 0: self.negative_reward += reward
+        self.trial_length += 1
+        self.reached_destination = reward > 2
+        if self.reached_destination or deadline == 0: self.save_trial_stats()
+
     def update_state(self, inputs):
         self.state['env'] = inputs
         self.state['desired_direction'] = self.next_waypoint
@@ -107,35 +134,28 @@ class LearningAgent(Agent):
         """
         self.verbose_output(("------------------------------------\n"
             + "policy(s):\n"
-            + "Exploration Probability: {}").format(exploration_probability))
+            + "Exploration Probability: {}"), exploration_probability)
 
         if random.uniform(0, 1) < exploration_probability:
             self.verbose_output("Exploring")
             action = random.choice(self.actions)
         else:
-            q_values = self.Q_values(s)
-            self.verbose_output("state_string: {}".format(self.state_string(s)))
-            self.verbose_output("Q Values for state: {}".format(q_values))
-            sorted_q_value_tuples = sorted(q_values.items(), key=operator.itemgetter(1), reverse=True)
-            q_max_tuple = sorted_q_value_tuples[0]
-            action = q_max_tuple[0]
-        self.verbose_output("Chosen action: {}".format(action))
+            self.verbose_output("state_string: {}", lambda: self.state_string(s))
+            self.verbose_output("Q Values for state: {}", lambda: self.Q_values(s))
+            action = self.actions[np.argmax(self.q_table[self.state_index(s)])]
+        self.verbose_output("Chosen action: {}", action)
         return action
 
     def Q_get(self, s, a):
         """Gets the Q value for the given state-action pair."""
-        state_string = self.state_string(s)
-        if state_string in self.q_states and a in self.q_states[state_string]:
-            return self.q_states[state_string][a]
-        return 0
+        i, j = self.state_index(s), self.action_index[a]
+        if self.n_table[i, j] == 0:
+            return 0  # never visited, so never set
+        return float(self.q_table[i, j])
 
     def Q_set(self, s, a, v):
         """Sets Q for the given state-action pair to the given value."""
-        state_string = self.state_string(s)
-        if state_string in self.q_states:
-            self.q_states[state_string][a] = v
-        else:
-            self.q_states[state_string] = {a: v}
+        self.q_table[self.state_index(s), self.action_index[a]] = v
 
     def Q_values(self, s):
         """Gets Q(s,a) for all actions and the given state."""
@@ -143,30 +163,41 @@ class LearningAgent(Agent):
 
     def Q_max(self, s):
         """Gets the maximum Q(s,a) value for the given state."""
-        return sorted([self.Q_get(s, a) for a in self.actions], reverse=True)[0]
+        return float(self.q_table[self.state_index(s)].max())
 
     def N_get(self, s, a):
         """Gets the N value for the given state-action pair."""
-        state_string = self.state_string(s)
-        if state_string in self.n_states and a in self.n_states[state_string]:
-                return self.n_states[state_string][a]
-        return 0
+        return int(self.n_table[self.state_index(s), self.action_index[a]])
 
     def N_increment(self, s, a):
         """Increments the N value for the given state-action pair."""
-        state_string = self.state_string(s)
-        if state_string in self.n_states:
-            if a in self.n_states[state_string]:
-                self.n_states[state_string][a] += 1
-            else:
-                self.n_states[state_string][a] = 1
-        else:
-            self.n_states[state_string] = {a: 1}
-        return self.n_states[state_string][a]
+        i, j = self.state_index(s), self.action_index[a]
+        self.n_table[i, j] += 1
+        return int(self.n_table[i, j])
 
     def N_max(self, s):
         """Gets the maximum N(s,a) value for the given state."""
-        return sorted([self.N_get(s, a) for a in self.actions], reverse=True)[0]
+        return int(self.n_table[self.state_index(s)].max())
+
+    def state_index(self, s):
+        """
+        Encodes the given state as its (dense, integer) index in
+        possible_states, i.e. the row of the state in the Q and N tables.
+        """
+        env = s['env']
+        a = self.action_index
+        return self.encode_state(self.light_index[env['light']], a[env['oncoming']], a[env['right']], a[env['left']],
+                                 self.desired_direction_index[s['desired_direction']])
+
+    @classmethod
+    def encode_state(cls, light, oncoming, right, left, desired_direction):
+        """
+        Combines the indices of a state's parts (in light_index, action_index
+        and desired_direction_index) into the state's index. Also works
+        element-wise on arrays of indices.
+        """
+        a = len(cls.actions)
+        return (((light * a + oncoming) * a + right) * a + left) * len(cls.desired_direction_index) + desired_direction
 
     def state_string(self, s):
         """Encodes the given state into a suitably short string."""
@@ -177,6 +208,16 @@ class LearningAgent(Agent):
         dd = s['desired_direction']
         return "tl:{},o:{},r:{},l:{},dd:{}".format(tl, o, r, l, dd)
 
+    def parse_state_string(self, string):
+        """Decodes a string produced by state_string back into a state."""
+        fields = dict(field.split(':') for field in string.split(','))
+        action = lambda value: None if value == 'None' else value
+        return {
+                'env': {'light': fields['tl'], 'oncoming': action(fields['o']),
+                        'right': action(fields['r']), 'left': action(fields['l'])},
+                'desired_direction': fields['dd']
+            }
+
     def state_action_matrix_string(self, getter):
         """
         Constructs a formatted multiline string that describes either the
@@ -237,72 +278,299 @@ class LearningAgent(Agent):
                                 })
         return states
 
-    def verbose_output(self, string):
+    def verbose_output(self, template, *args):
+        """
+        Prints the template formatted with the given arguments when verbose
+        debugging is enabled. Nothing is formatted otherwise, and callable
+        arguments are only called when needed, so expensive payloads such as
+        the Q(s,a) and N(s,a) matrices should be passed as callables.
+        """
         if self.verbose_debugging:
-            print string
+            print template.format(*[arg() if callable(arg) else arg for arg in args])
 
     def save_trial_stats(self):
         """
-        Saves the statistics for the current trial in the trial_stats DataFram
-        and reports the data of the simulation has come to an end.
+        Saves the statistics for the current trial in the trial_stats recorder
+        and reports the data of the simulation has come to an end. A due
+        checkpoint is left to update(), to be saved after the Q(s,a) and
+        N(s,a) update of the trial's last step.
         """
-        trial_data = [self.total_reward, self.negative_reward, self.trial_length, self.reached_destination]
-        trial_df = pd.DataFrame([trial_data], columns=self.trial_stats_columns)
-        if self.trial_stats.empty:
-            self.trial_stats = trial_df
-        else:
-            self.trial_stats = self.trial_stats.append(trial_df, ignore_index=True)
-        if self.trial_stats.shape[0] == 100:
-            print "*****\nReporting Data\n*****"
+        self.trial_stats.record(self.total_reward, self.negative_reward, self.trial_length, self.reached_destination)
+        self.trials_completed += 1
+        if self.results_writer is not None:
+            self.results_writer.trial_recorded(self.matrices_string)
+        if self.checkpoint_every and self.trials_completed % self.checkpoint_every == 0:
+            self.checkpoint_due = True
+        if self.trials_completed == self.n_trials:
+            log.emit(INFO, "LearningAgent.save_trial_stats()", "Reporting Data")
             self.report_data()
 
     def report_data(self):
         """
-        Writes the contents of the trial stats DataFrame to a CSV file and the
-        contents pf the Q(s,a) and N(s,a) matrices to a text file.
+        Writes the contents of the trial stats recorder to a CSV file (or
+        flushes the remaining trials when they are being streamed) and the
+        contents pf the Q(s,a) and N(s,a) matrices to a text file, along with
+        a lossless .npz copy of the matrices. When a results store is set,
+        the run is appended to the store instead.
         """
-        self.trial_stats.to_csv(self.file_name('trial_stats', 'csv'))
+        if self.results_store is not None:
+            self.store_run_id = self.results_store.add_run(self.alpha, self.gamma, self.epsilon,
+                {c: self.trial_stats.column(c) for c in self.trial_stats_columns},
+                self.q_table, self.n_table, seed=self.seed, label=self.run_id)
+            return
+        if self.results_writer is not None:
+            self.results_writer.close()
+            self.results_writer = None  # the run's files are complete
+        else:
+            self.trial_stats.to_csv(self.file_name('trial_stats', 'csv'))
         matrices_text_file = open(self.file_name('Q_and_N', 'txt'), "w")
-        matrices_text_file.write("Q(s,a):\n")
-        matrices_text_file.write(self.state_action_matrix_string(self.Q_get))
-        matrices_text_file.write("\n")
-        matrices_text_file.write("N(s,a):\n")
-        matrices_text_file.write(self.state_action_matrix_string(self.N_get))
+        matrices_text_file.write(self.matrices_string())
         matrices_text_file.close()
+        np.savez(self.file_name('Q_and_N', 'npz'), q=self.q_table, n=self.n_table)
+
+    def matrices_string(self):
+        """The Q(s,a) and N(s,a) matrices, as written to the Q_and_N text file."""
+        return ("Q(s,a):\n" + self.state_action_matrix_string(self.Q_get) + "\n"
+                + "N(s,a):\n" + self.state_action_matrix_string(self.N_get))
+
+    def stream_results(self, batch_size=10, checkpoint_every=25):
+        """
+        Streams trial stats to the CSV file in batches of batch_size trials as
+        the run progresses, and rewrites the Q_and_N text file with the current
+        matrices every checkpoint_every trials.
+        """
+        self.results_writer = StreamingTrialWriter(self.trial_stats, self.file_name('trial_stats', 'csv'), batch_size,
+                                                   self.file_name('Q_and_N', 'txt'), checkpoint_every)
+
+    def save_checkpoint(self, path):
+        """
+        Saves the agent's learning state to a .npz file: Q(s,a), N(s,a), the
+        Q-Learning parameters, the number of trials completed and the state of
+        the random number generator. The file is written under a temporary
+        name and renamed into place, so an existing checkpoint is only ever
+        replaced by a complete one.
+        """
+        version, internal_state, gauss_next = random.getstate()
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as checkpoint_file:
+            np.savez(checkpoint_file, q=self.q_table, n=self.n_table,
+                     parameters=np.array([self.alpha, self.gamma, self.epsilon]),
+                     trials_completed=self.trials_completed, rng_version=version,
+                     rng_state=np.array(internal_state, dtype=np.int64),
+                     rng_gauss_next=np.nan if gauss_next is None else gauss_next)
+        os.rename(temporary_path, path)
+
+    def load_checkpoint(self, path, restore_parameters=True, restore_rng=True):
+        """
+        Restores the learning state saved by save_checkpoint. The Q-Learning
+        parameters and the random number generator are only restored when
+        requested, e.g. so that a trained policy can be fine-tuned with
+        different parameters. The trial count carries on from the checkpoint,
+        so a resumed run is reported once n_trials trials are complete in
+        total, but the trial stats start afresh.
+        """
+        with np.load(path) as checkpoint:
+            if checkpoint['q'].shape != self.q_table.shape:
+                raise ValueError("The checkpoint's Q(s,a) has shape {} rather than {}".format(
+                    checkpoint['q'].shape, self.q_table.shape))
+            self.q_table = checkpoint['q'].copy()
+            self.n_table = checkpoint['n'].copy()
+            self.trials_completed = int(checkpoint['trials_completed'])
+            if restore_parameters:
+                self.alpha, self.gamma, self.epsilon = checkpoint['parameters'].tolist()
+            if restore_rng:
+                gauss_next = float(checkpoint['rng_gauss_next'])
+                random.setstate((int(checkpoint['rng_version']), tuple(checkpoint['rng_state'].tolist()),
+                                 None if np.isnan(gauss_next) else gauss_next))
+
+    def load_tables_csv(self, q_path, n_path=None):
+        """
+        Warm starts the agent from Q(s,a), and optionally N(s,a), tables in the
+        CSV format of data/Q_optimal_*.csv and data/N_optimal_*.csv: a State
+        column, with states encoded as by state_string but separated by '_'
+        rather than ',', and a column per action. States that are not listed
+        keep their current values. Without an N(s,a) table, the loaded Q
+        values that have never been visited are counted as visited once, since
+        Q_get ignores the values of unvisited state-action pairs.
+        """
+        import pandas as pd
+        for path, table in ((q_path, self.q_table), (n_path, self.n_table)):
+            if path is None:
+                continue
+            df = pd.read_csv(path)
+            rows = [self.state_index(self.parse_state_string(state.replace('_', ','))) for state in df.State]
+            table[rows] = df[[str(a) for a in self.actions]].values
+            if n_path is None:
+                self.n_table[rows] = np.maximum(self.n_table[rows], 1)
 
     def file_name(self, base, file_extension):
         """
         Generates an appropriate file name given the base file neame,
-        file extension, state space size and Q-Learning parameters.
+        file extension, run id, state space size and Q-Learning parameters.
+        All of a run's files share the timestamp of the first file name
+        generated.
         """
-        ts = time.time()
-        st = datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d_%H:%M:%S')
+        if self.file_timestamp is None:
+            self.file_timestamp = time.time()
+        st = datetime.datetime.fromtimestamp(self.file_timestamp).strftime('%Y-%m-%d_%H:%M:%S')
+        if self.run_id is not None:
+            st = "{}_{}".format(st, self.run_id)
         state_size = len(self.possible_states)
-        return "./data/{}_{}_q_agent_states:{}_a:{}_g:{}_e:{}.{}".format(
+        return os.path.join(self.output_dir, "{}_{}_q_agent_states:{}_a:{}_g:{}_e:{}.{}".format(
                 base, st, state_size, self.alpha, self.gamma, self.epsilon, file_extension
-            )
+            ))
+
+class FrozenPolicyAgent(LearningAgent):
+    """
+    An agent that drives with the greedy policy of a learned Q(s,a) table,
+    without exploring or learning: the table is compiled into a flat array of
+    the best action for each encoded state (as LearningAgent.state_index
+    encodes them), so choosing an action is a single array index. The trial
+    stats are recorded as by LearningAgent, but never reported.
+    """
+
+    # Environment.valid_actions codes (as used by BatchEnvironment) to and from indices into actions
+    from_env_action = np.array([LearningAgent.action_index[a] for a in Environment.valid_actions])
+    to_env_action = np.array([Environment.valid_actions.index(a) for a in LearningAgent.actions])
+    from_env_desired_direction = np.array([LearningAgent.desired_direction_index.get(a, 0)
+                                           for a in Environment.valid_actions])
+
+    def __init__(self, env, q_table):
+        super(FrozenPolicyAgent, self).__init__(env)
+        self.n_trials = None  # nothing to report; the trial stats are read from trial_stats
+        self.q_table = np.array(q_table, dtype=float)
+        self.action_table = np.argmax(self.q_table, axis=1)  # first best action, as in LearningAgent.policy
+        self.env_action_table = self.to_env_action[self.action_table]
 
-def run(alpha=0.5, gamma=0.5, epsilon=0.5):
-    """Run the agent for a finite number of trials."""
+    def update(self, t):
+        self.next_waypoint = self.planner.next_waypoint()
+        inputs = self.env.sense(self)
+        deadline = self.env.get_deadline(self)
+        self.update_state(inputs)
+        reward = self.env.act(self, self.actions[self.action_table[self.state_index(self.state)]])
+        self.record_reward(reward, deadline)
+
+    def act(self, states):
+        """The greedy actions, as indices into actions, for an array of encoded states."""
+        return self.action_table[states]
+
+    def encode_states(self, light_green, oncoming, right, left, next_waypoint):
+        """
+        Encodes arrays of BatchEnvironment inputs (Environment.valid_actions
+        codes and a boolean light) as the states indexing the action table.
+        """
+        light = np.where(light_green, self.light_index['green'], self.light_index['red'])
+        return self.encode_state(light, self.from_env_action[oncoming], self.from_env_action[right],
+                                 self.from_env_action[left], self.from_env_desired_direction[next_waypoint])
+
+    def batch_policy(self):
+        """The policy as a BatchEnvironment primary policy, returning action codes."""
+        def policy(inputs, next_waypoint, deadline):
+            states = self.encode_states(inputs['light'], inputs['oncoming'], inputs['right'], inputs['left'],
+                                        next_waypoint)
+            return self.env_action_table[states]
+        return policy
+
+
+def create_simulation(alpha=0.5, gamma=0.5, epsilon=0.5, n_trials=100, stream_results=True, seed=None,
+                      output_dir='./data', results_store=None, resume_from=None, warm_start=None,
+                      checkpoint_every=None, capture=None):
+    """
+    Sets up the environment, the learning agent and the simulator for a run
+    of n_trials and returns (simulator, agent). The simulator has not been
+    run yet, so it can be run in one go or a few trials at a time; a run
+    resumed from a checkpoint has n_trials - agent.trials_completed trials
+    left. With a results store, the agent's ResultsStore is to be closed once the run is
+    over.
+    """
+
+    if seed is not None:
+        random.seed(seed)
 
     # Set up environment and agent
     e = Environment()  # create environment (also adds some dummy traffic)
     a = e.create_agent(LearningAgent)  # create agent
 
+    # Restore previously learned Q(s,a) and N(s,a) (the parameters given here still apply)
+    if resume_from is not None:
+        a.load_checkpoint(resume_from, restore_parameters=False)
+        if a.trials_completed >= n_trials:
+            raise ValueError("The checkpoint has already completed {} trials of the {} to run".format(
+                a.trials_completed, n_trials))
+    if warm_start is not None:
+        a.load_tables_csv(*warm_start)
+
     # Set agent parameters
     a.alpha = alpha
     a.gamma = gamma
     a.epsilon = epsilon
+    a.n_trials = n_trials
+    a.output_dir = output_dir
+    a.checkpoint_every = checkpoint_every
+    if seed is not None:
+        a.seed = seed
+        a.run_id = "seed:{}".format(seed)
+    if results_store is not None:
+        a.results_store = ResultsStore(results_store)
+    elif stream_results:
+        a.stream_results()
 
     e.set_primary_agent(a, enforce_deadline=True)  # specify agent to track
     # NOTE: You can set enforce_deadline=False while debugging to allow longer trials
 
     # Now simulate it
-    sim = Simulator(e, update_delay=0, display=False)  # create simulator (uses pygame when display=True, if available)
+    sim = Simulator(e, update_delay=0, display=False, offscreen=capture is not None, capture=capture)  # create simulator (uses pygame when display=True, if available)
     # NOTE: To speed up simulation, reduce update_delay and/or set display=False
 
-    sim.run(n_trials=100)  # run for a specified number of trials
-    # NOTE: To quit midway, press Esc or close pygame window, or hit Ctrl+C on the command-line
+    return sim, a
+
+
+def evaluate(q_table, n_trials=100, seed=None, num_dummies=3, capture=None):
+    """
+    Runs a FrozenPolicyAgent with the greedy policy of the given Q(s,a)
+    table for n_trials trials and returns it; its trial_stats hold the
+    results. With a FrameCapture, frames of the trials are saved offscreen.
+    """
+    if seed is not None:
+        random.seed(seed)
+    e = Environment(num_dummies=num_dummies)
+    a = e.create_agent(FrozenPolicyAgent, q_table)
+    e.set_primary_agent(a, enforce_deadline=True)
+    sim = Simulator(e, update_delay=0, display=False, offscreen=capture is not None, capture=capture)
+    sim.run_headless(n_trials=n_trials)
+    return a
+
+
+def run(alpha=0.5, gamma=0.5, epsilon=0.5, n_trials=100, stream_results=True, seed=None, output_dir='./data',
+        results_store=None, resume_from=None, warm_start=None, checkpoint_every=None, capture=None):
+    """
+    Run the agent for a finite number of trials and return it. With
+    stream_results, trial stats and Q/N checkpoints are written to disk as the
+    run progresses. When a seed is given the run is reproducible, and the seed
+    is included in the names of the files written to output_dir. When the
+    path of a results store is given, the results are appended to that
+    database instead of being written to files.
+
+    The agent can start from previously learned tables: resume_from is the
+    path of a checkpoint saved by LearningAgent.save_checkpoint (whose RNG
+    state and trial count are also restored, so that only the remaining
+    trials of the n_trials are run), and warm_start is a (Q CSV path, N CSV path)
+    pair such as the optimal tables in ./data. With checkpoint_every, a
+    checkpoint is saved to output_dir every that many trials.
+
+    With a capture (a FrameCapture), frames of the run are rendered offscreen
+    and saved as it goes; the caller closes the capture afterwards.
+    """
+    sim, a = create_simulation(alpha, gamma, epsilon, n_trials, stream_results, seed, output_dir, results_store,
+                               resume_from, warm_start, checkpoint_every, capture)
+
+    sim.run_headless(n_trials=n_trials - a.trials_completed)  # run the remaining trials, as fast as possible
+    # NOTE: To quit midway, hit Ctrl+C on the command-line
+
+    if a.results_store is not None:
+        a.results_store.close()
+
+    return a
 
 
 if __name__ == '__main__':
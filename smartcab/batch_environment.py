@@ -0,0 +1,284 @@
+import numpy as np
+
+from environment import Environment
+from planner import waypoint_table
+from transitions import TransitionTables
+
+# Integer codes used throughout the batched engine. Actions and headings are
+# indices into Environment.valid_actions and Environment.valid_headings.
+NONE, FORWARD, LEFT, RIGHT = range(len(Environment.valid_actions))
+EAST, NORTH, WEST, SOUTH = range(len(Environment.valid_headings))
+
+HEADING_DX = np.array([h[0] for h in Environment.valid_headings])
+HEADING_DY = np.array([h[1] for h in Environment.valid_headings])
+
+TRANSITIONS = TransitionTables(Environment.valid_actions, Environment.valid_headings).as_arrays()
+
+
+class BatchEnvironment(object):
+    """
+    Steps K independent smartcab worlds at once. Every world follows the same
+    rules as Environment.step and Environment.act, but all agent and traffic
+    light state lives in (worlds, ...) arrays so that sensing, acting and
+    rewards are computed for every world in a single vectorised call.
+
+    Agents are indexed in creation order: the dummy agents come first and the
+    primary agent, if any, is last (as in agent.run). Actions, inputs and
+    waypoints are encoded as indices into Environment.valid_actions.
+    """
+
+    hard_time_limit = Environment.hard_time_limit
+    min_trip_distance = Environment.min_trip_distance
+
+    def __init__(self, num_worlds, num_dummies=3, grid_size=(8, 6), seed=None):
+        self.num_worlds = num_worlds
+        self.num_dummies = num_dummies
+        self.random = np.random.RandomState(seed)
+
+        # Road network
+        self.grid_size = grid_size  # (cols, rows)
+        self.bounds = (1, 1, self.grid_size[0], self.grid_size[1])
+        self.num_intersections = self.grid_size[0] * self.grid_size[1]
+        self.min_start_distance = min(self.min_trip_distance, self.grid_size[0] // 2 + self.grid_size[1] // 2)
+        if self.min_start_distance < 1:
+            raise ValueError("A grid of size {} has no room for a trip".format(self.grid_size))
+        # routes[route_slot[destination], location, heading] -> action code of the primary agent's next waypoint,
+        # for the destinations in use (fetched from the grid's WaypointTable when they first come up)
+        self.waypoint_table = waypoint_table(self.bounds, Environment.valid_headings)
+        self.routes = np.empty((0, self.num_intersections, len(Environment.valid_headings)), dtype=np.int8)
+        self.route_slot = np.full(self.num_intersections, -1, dtype=int)
+
+        # Traffic lights, one row per world (same ordering as Environment.intersections)
+        shape = (self.num_worlds, self.num_intersections)
+        self.light_state = self.random.randint(0, 2, size=shape).astype(bool)  # True = NS open
+        self.light_period = self.random.choice([3, 4, 5], size=shape)
+        self.light_last_updated = np.zeros(shape, dtype=int)
+
+        # Primary agent and associated parameters
+        self.primary_policy = None  # to be set explicitly
+        self.enforce_deadline = False
+        self._allocate_agents(self.num_dummies)
+
+        self.t = np.zeros(self.num_worlds, dtype=int)
+        self.done = np.zeros(self.num_worlds, dtype=bool)
+        self.success = np.zeros(self.num_worlds, dtype=bool)
+        self.destination_x = np.zeros(self.num_worlds, dtype=int)
+        self.destination_y = np.zeros(self.num_worlds, dtype=int)
+        self.deadline = np.zeros(self.num_worlds, dtype=int)
+
+    def _allocate_agents(self, num_agents):
+        shape = (self.num_worlds, num_agents)
+        self.x = self.random.randint(self.bounds[0], self.bounds[2] + 1, size=shape)
+        self.y = self.random.randint(self.bounds[1], self.bounds[3] + 1, size=shape)
+        self.heading = np.full(shape, SOUTH, dtype=int)
+        self.next_waypoint = self.random.randint(FORWARD, RIGHT + 1, size=shape)  # dummies start with a random waypoint
+
+    @property
+    def num_agents(self):
+        return self.x.shape[1]
+
+    @property
+    def primary(self):
+        """Index of the primary agent, or None when there is no primary agent."""
+        return self.num_dummies if self.primary_policy is not None else None
+
+    def set_primary_policy(self, policy, enforce_deadline=False):
+        """
+        Adds a primary agent to every world. The policy is called once per step
+        as policy(inputs, next_waypoint, deadline) with (worlds,) arrays, inputs
+        being a dict like the one returned by sense(), and must return an array
+        of action codes.
+        """
+        if self.primary_policy is None:
+            # The primary agent is created after the dummies, as in agent.run
+            x, y, heading, waypoint = self.x, self.y, self.heading, self.next_waypoint
+            self._allocate_agents(self.num_dummies + 1)
+            self.x[:, :-1], self.y[:, :-1], self.heading[:, :-1] = x, y, heading
+            self.next_waypoint[:, :-1] = waypoint
+            self.next_waypoint[:, -1] = NONE
+        self.primary_policy = policy
+        self.enforce_deadline = enforce_deadline
+
+    def reset(self, worlds=None):
+        """Starts a new trial in the given worlds (a boolean mask; default: all)."""
+        worlds = np.ones(self.num_worlds, dtype=bool) if worlds is None else np.array(worlds, dtype=bool)
+        n = np.count_nonzero(worlds)
+        if n == 0:
+            return
+        self.done[worlds] = False
+        self.success[worlds] = False
+        self.t[worlds] = 0
+
+        # Reset traffic lights
+        self.light_last_updated[worlds] = 0
+
+        # Pick a start and a destination, ensuring they are not too close
+        start_x, start_y = self._random_locations(n)
+        dest_x, dest_y = self._random_locations(n)
+        too_close = self.compute_dist(start_x, start_y, dest_x, dest_y) < self.min_start_distance
+        while too_close.any():
+            m = np.count_nonzero(too_close)
+            start_x[too_close], start_y[too_close] = self._random_locations(m)
+            dest_x[too_close], dest_y[too_close] = self._random_locations(m)
+            too_close = self.compute_dist(start_x, start_y, dest_x, dest_y) < self.min_start_distance
+
+        self.destination_x[worlds] = dest_x
+        self.destination_y[worlds] = dest_y
+        self.deadline[worlds] = self.compute_dist(start_x, start_y, dest_x, dest_y) * 5
+
+        # Initialize agent(s)
+        x, y = self._random_locations(n * self.num_agents)
+        self.x[worlds] = x.reshape(n, self.num_agents)
+        self.y[worlds] = y.reshape(n, self.num_agents)
+        self.heading[worlds] = self.random.randint(0, 4, size=(n, self.num_agents))
+        if self.primary is not None:
+            self.x[worlds, self.primary] = start_x
+            self.y[worlds, self.primary] = start_y
+
+    def _random_locations(self, n):
+        return (self.random.randint(self.bounds[0], self.bounds[2] + 1, size=n),
+                self.random.randint(self.bounds[1], self.bounds[3] + 1, size=n))
+
+    def step(self):
+        """
+        Advances every world that is not done by one time step and returns the
+        primary agent's reward for each world (0 where nothing happened).
+        """
+        active = ~self.done
+        rewards = np.zeros(self.num_worlds)
+
+        # Update traffic lights
+        flip = (self.t[:, np.newaxis] - self.light_last_updated >= self.light_period) & active[:, np.newaxis]
+        self.light_state ^= flip
+        self.light_last_updated = np.where(flip, self.t[:, np.newaxis], self.light_last_updated)
+
+        # Update agents
+        for agent in xrange(self.num_agents):
+            if agent == self.primary:
+                self.next_waypoint[:, agent] = self.planned_waypoint()
+                inputs = self.sense(agent)
+                actions = np.asarray(self.primary_policy(inputs, self.next_waypoint[:, agent], self.deadline))
+                rewards = self.act(agent, actions, active, inputs)
+            else:
+                self._update_dummy(agent, active)
+
+        # Deadlines, for worlds where the primary agent has not finished
+        if self.primary is not None:
+            running = active & ~self.done
+            hit_limit = running & (self.deadline <= self.hard_time_limit)
+            self.done |= hit_limit
+            if self.enforce_deadline:
+                self.done |= running & ~hit_limit & (self.deadline <= 0)
+            self.deadline[running] -= 1
+            self.t[running] += 1
+        else:
+            self.t[active] += 1
+
+        return rewards
+
+    def _update_dummy(self, agent, active):
+        """Vectorised equivalent of DummyAgent.update."""
+        inputs = self.sense(agent)
+        waypoint = self.next_waypoint[:, agent]
+        red = ~inputs['light']
+        blocked = np.where(waypoint == RIGHT, red & (inputs['left'] == FORWARD),
+                  np.where(waypoint == FORWARD, red,
+                  np.where(waypoint == LEFT, red | (inputs['oncoming'] == FORWARD) | (inputs['oncoming'] == RIGHT),
+                           False)))
+        okay = active & ~blocked
+        actions = np.where(okay, waypoint, NONE)
+        self.next_waypoint[:, agent] = np.where(okay, self.random.randint(FORWARD, RIGHT + 1, size=self.num_worlds), waypoint)
+        self.act(agent, actions, active, inputs)
+
+    def light_green(self, agent):
+        """Whether the light is green for the given agent, in every world."""
+        return TRANSITIONS['light_green'][self.light_phase(agent), self.heading[:, agent]]
+
+    def light_phase(self, agent):
+        """State of the light at the given agent's intersection, in every world, as a 0/1 index."""
+        return self.light_state[np.arange(self.num_worlds), self.intersection_index(self.x[:, agent], self.y[:, agent])].astype(int)
+
+    def intersection_index(self, x, y):
+        """Maps locations to indices in Environment.intersections order."""
+        return (x - self.bounds[0]) * self.grid_size[1] + (y - self.bounds[1])
+
+    def sense(self, agent):
+        """Vectorised Environment.sense: returns a dict of (worlds,) arrays."""
+        present = ((self.x == self.x[:, agent, np.newaxis]) & (self.y == self.y[:, agent, np.newaxis])
+                   & (self.heading != self.heading[:, agent, np.newaxis]))
+        present[:, agent] = False
+        relation = (self.heading - self.heading[:, agent, np.newaxis]) % 4
+        # Environment.sense doesn't override oncoming == 'left', right == 'forward' or 'left', or left == 'forward'
+        return {'light': self.light_green(agent),
+                'oncoming': self._resolve_input(present & (relation == 2), (LEFT,)),
+                'left': self._resolve_input(present & (relation == 3), (FORWARD,)),
+                'right': self._resolve_input(present & (relation == 1), (FORWARD, LEFT))}
+
+    def _resolve_input(self, mask, sticky):
+        """
+        Reduces the waypoints of the agents selected by the (worlds, agents)
+        mask to the value Environment.sense ends up with when it visits them in
+        order: the first waypoint that may not be overridden, if any, otherwise
+        the last one seen.
+        """
+        waypoints = self.next_waypoint
+        sticky_mask = mask & np.in1d(waypoints, sticky).reshape(waypoints.shape)
+        last = mask.shape[1] - 1 - np.argmax(mask[:, ::-1], axis=1)
+        chosen = np.where(sticky_mask.any(axis=1), np.argmax(sticky_mask, axis=1), last)
+        return np.where(mask.any(axis=1), waypoints[np.arange(self.num_worlds), chosen], NONE)
+
+    def act(self, agent, actions, active=None, inputs=None):
+        """
+        Vectorised Environment.act: applies the action codes for the given agent
+        in every active world and returns the rewards.
+        """
+        active = ~self.done if active is None else active
+        inputs = self.sense(agent) if inputs is None else inputs
+        heading = self.heading[:, agent]
+        outcome = (self.light_phase(agent), heading, actions, inputs['oncoming'], inputs['left'])
+        new_heading = TRANSITIONS['next_heading'][outcome]
+        reward = TRANSITIONS['reward'][outcome + (self.next_waypoint[:, agent],)]
+
+        moving = active & TRANSITIONS['moved'][outcome]
+        width = self.bounds[2] - self.bounds[0] + 1
+        height = self.bounds[3] - self.bounds[1] + 1
+        new_x = (self.x[:, agent] + HEADING_DX[new_heading] - self.bounds[0]) % width + self.bounds[0]  # wrap-around
+        new_y = (self.y[:, agent] + HEADING_DY[new_heading] - self.bounds[1]) % height + self.bounds[1]
+        self.x[:, agent] = np.where(moving, new_x, self.x[:, agent])
+        self.y[:, agent] = np.where(moving, new_y, self.y[:, agent])
+        self.heading[:, agent] = np.where(moving, new_heading, heading)
+
+        if agent == self.primary:
+            arrived = active & (self.x[:, agent] == self.destination_x) & (self.y[:, agent] == self.destination_y)
+            reward = np.where(arrived & (self.deadline >= 0), reward + 10, reward)  # bonus
+            self.done |= arrived
+            self.success |= arrived
+
+        return np.where(active, reward, 0.0)
+
+    def planned_waypoint(self):
+        """Vectorised RoutePlanner.next_waypoint for the primary agent: a lookup in the routes."""
+        destination = self.intersection_index(self.destination_x, self.destination_y)
+        slot = self.route_slot[destination]
+        if (slot < 0).any():
+            self._add_routes(np.unique(destination[slot < 0]))
+            slot = self.route_slot[destination]
+        location = self.intersection_index(self.x[:, self.primary], self.y[:, self.primary])
+        return self.routes[slot, location, self.heading[:, self.primary]]
+
+    def _add_routes(self, destinations):
+        if len(self.routes) + len(destinations) > 2 * self.num_worlds:
+            # Only keep the routes to the destinations still in use
+            in_use = np.unique(self.intersection_index(self.destination_x, self.destination_y))
+            in_use = in_use[self.route_slot[in_use] >= 0]
+            self.routes = self.routes[self.route_slot[in_use]]
+            self.route_slot[:] = -1
+            self.route_slot[in_use] = np.arange(len(in_use))
+        self.route_slot[destinations] = len(self.routes) + np.arange(len(destinations))
+        self.routes = np.concatenate([self.routes] + [self.waypoint_table.as_codes(d, Environment.valid_actions)[np.newaxis]
+                                                      for d in destinations])
+
+    def compute_dist(self, ax, ay, bx, by):
+        """L1 distance between two (arrays of) points on the wrap-around grid."""
+        dx, dy = np.abs(bx - ax), np.abs(by - ay)
+        return np.minimum(dx, self.grid_size[0] - dx) + np.minimum(dy, self.grid_size[1] - dy)
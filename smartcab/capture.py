@@ -0,0 +1,123 @@
+import json
+import os
+import struct
+import threading
+import zlib
+from Queue import Queue
+
+import numpy as np
+
+
+def png_chunk(tag, data):
+    return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+
+def write_png(path, width, height, rgb, level=6):
+    """
+    Writes 8-bit RGB pixels (a string of height rows of width pixels) as a
+    PNG file. Each row is stored with the Sub filter, which suits the large
+    flat areas of the simulator's frames.
+    """
+    rows = np.frombuffer(rgb, dtype=np.uint8).reshape(height, width * 3)
+    filtered = np.empty((height, width * 3 + 1), dtype=np.uint8)
+    filtered[:, 0] = 1  # Sub: each byte minus the same byte of the pixel to its left
+    filtered[:, 1:4] = rows[:, :3]
+    filtered[:, 4:] = rows[:, 3:] - rows[:, :-3]  # modulo 256
+    with open(path, 'wb') as png_file:
+        png_file.write('\x89PNG\r\n\x1a\n')
+        png_file.write(png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)))
+        png_file.write(png_chunk('IDAT', zlib.compress(filtered.tobytes(), level)))
+        png_file.write(png_chunk('IEND', ''))
+
+
+class FrameCapture(object):
+    """
+    Captures rendered frames of a simulation to disk, for use with
+    Simulator(capture=...): every Nth step (and the last step) of each
+    trial, optionally only in selected trials (numbered from 0 in the order
+    the simulator runs them).
+
+    The simulator only copies each frame's pixels; the frames are written
+    by a background thread, so encoding does not hold up the stepping. At
+    most queue_size frames wait to be written, after which the simulator
+    waits for the writer.
+
+    With format 'png', each frame is a PNG file named after its trial and
+    step. With format 'raw', the frames are appended, uncompressed, to a
+    single frames.rgb stream of 8-bit RGB pixels, and frames.json records
+    the frame size and the (trial, step) of each frame; the stream can be
+    encoded as a video with e.g.
+    ffmpeg -f rawvideo -pix_fmt rgb24 -s <width>x<height> -i frames.rgb out.mp4
+
+    close() must be called once the simulation is over, to write the
+    remaining frames (and the index of a raw stream).
+    """
+
+    formats = ['png', 'raw']
+
+    def __init__(self, output_dir, every=1, trials=None, format='png', queue_size=64):
+        assert format in self.formats, "Invalid format!"
+        self.output_dir = output_dir
+        self.every = every
+        self.trials = set(trials) if trials is not None else None
+        self.format = format
+        self.trial = -1  # trial being simulated
+        self.size = None
+        self.frames = []  # (trial, step) of every frame captured
+        self.error = None  # raised by the writer thread
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+        self.stream = open(os.path.join(self.output_dir, 'frames.rgb'), 'wb') if format == 'raw' else None
+        self.queue = Queue(maxsize=queue_size)
+        self.writer = threading.Thread(target=self.write_frames, name="FrameCapture writer")
+        self.writer.daemon = True
+        self.writer.start()
+
+    def start_trial(self):
+        """To be called by the simulator when a trial starts."""
+        self.trial += 1
+
+    def wants(self, t, done):
+        """Whether the frame after step t of the current trial (t = 0 when it starts) is to be captured."""
+        return (self.trials is None or self.trial in self.trials) and (t % self.every == 0 or done)
+
+    def add_frame(self, surface, t):
+        """Queues a copy of the surface's pixels as the frame after step t of the current trial."""
+        if self.error is not None:
+            raise self.error
+        import pygame
+        if self.size is None:
+            self.size = surface.get_size()
+        self.frames.append((self.trial, t))
+        self.queue.put((self.trial, t, pygame.image.tostring(surface, 'RGB')))
+
+    def write_frames(self):
+        while True:
+            frame = self.queue.get()
+            if frame is None:
+                return
+            if self.error is not None:
+                continue  # keep draining the queue so that the simulator is never blocked
+            trial, t, rgb = frame
+            try:
+                if self.stream is not None:
+                    self.stream.write(rgb)
+                else:
+                    write_png(os.path.join(self.output_dir, "trial_{:04d}_step_{:04d}.png".format(trial, t)),
+                              self.size[0], self.size[1], rgb)
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        """Waits for the queued frames to be written and closes the output."""
+        if self.writer.is_alive():
+            self.queue.put(None)
+            self.writer.join()
+        if self.stream is not None and not self.stream.closed:
+            self.stream.close()
+            with open(os.path.join(self.output_dir, 'frames.json'), 'w') as index_file:
+                json.dump({'width': self.size[0] if self.size else None, 'height': self.size[1] if self.size else None,
+                           'pix_fmt': 'rgb24', 'frames': self.frames}, index_file)
+        if self.error is not None:
+            raise self.error
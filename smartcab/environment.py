@@ -1,8 +1,14 @@
 import time
 import random
+import itertools
 from collections import OrderedDict
 
+import numpy as np
+
 from simulator import Simulator
+from eventlog import log, DEBUG, INFO
+from transitions import TransitionTables
+from traffic import TrafficKernel
 
 class TrafficLight(object):
     """A traffic light that switches periodically."""
@@ -23,6 +29,62 @@ class TrafficLight(object):
             self.last_updated = t
 
 
+class TrafficLightPhases(object):
+    """
+    Closed-form model of a set of periodic traffic lights. A light that is
+    updated on every tick flips exactly when t is a multiple of its period, so
+    its state at tick t is its state at the start of the trial, flipped once
+    for every full period elapsed. States can therefore be computed on demand,
+    for one light or all of them, at the current tick or any future one.
+    """
+
+    def __init__(self, states, periods):
+        self.initial_states = list(states)  # states at t = 0 of the current trial
+        self.periods = list(periods)
+        self.initial_states_array = np.array(self.initial_states, dtype=bool)
+        self.periods_array = np.array(self.periods, dtype=int)
+        self.t = 0  # tick the lights were last advanced to
+
+    @classmethod
+    def from_lights(cls, traffic_lights):
+        traffic_lights = list(traffic_lights)
+        return cls([light.state for light in traffic_lights], [light.period for light in traffic_lights])
+
+    def advance(self, t):
+        """Equivalent of calling TrafficLight.update(t) on every light."""
+        self.t = t
+
+    def reset(self):
+        """Equivalent of TrafficLight.reset: keeps the current states and restarts the clock."""
+        self.initial_states_array = self.states_at(self.t)
+        self.initial_states = self.initial_states_array.tolist()
+        self.t = 0
+
+    def state_of(self, index):
+        """State of a single light at the current tick."""
+        return self.initial_states[index] != ((self.t // self.periods[index]) % 2 == 1)
+
+    def states_at(self, t):
+        """States of all lights at tick t (of the current trial) as a boolean array."""
+        return self.initial_states_array ^ ((t // self.periods_array) % 2 == 1)
+
+
+class PhasedTrafficLight(object):
+    """A read-only view of one light in a TrafficLightPhases model, usable in place of a TrafficLight."""
+
+    def __init__(self, phases, index):
+        self.phases = phases
+        self.index = index
+
+    @property
+    def state(self):
+        return self.phases.state_of(self.index)
+
+    @property
+    def period(self):
+        return self.phases.periods[self.index]
+
+
 class Environment(object):
     """Environment within which all agents operate."""
 
@@ -30,44 +92,82 @@ class Environment(object):
     valid_inputs = {'light': TrafficLight.valid_states, 'oncoming': valid_actions, 'left': valid_actions, 'right': valid_actions}
     valid_headings = [(1, 0), (0, -1), (-1, 0), (0, 1)]  # ENWS
     hard_time_limit = -100  # even if enforce_deadline is False, end trial when deadline reaches this value (to avoid deadlocks)
+    min_trip_distance = 4  # between a trial's start and destination, where the grid is large enough
 
-    def __init__(self, num_dummies=3):
+    def __init__(self, num_dummies=3, analytic_lights=False, grid_size=(8, 6), batched_traffic=False):
         self.num_dummies = num_dummies  # no. of dummy agents
         
         # Initialize simulation variables
         self.done = False
         self.t = 0
         self.agent_states = OrderedDict()
-        self.status_text = ""
+        self.agent_order = {}  # agent -> creation index, the order in which agents are stepped and sensed
+        self.occupancy = {}  # intersection -> agents currently there, in creation order
+        self.status = None  # (state, action, reward) of the primary agent's last action
 
         # Road network
-        self.grid_size = (8, 6)  # (cols, rows)
+        self.grid_size = grid_size  # (cols, rows)
         self.bounds = (1, 1, self.grid_size[0], self.grid_size[1])
         self.block_size = 100
+        # The wrap-around distance is at most half the grid's width plus half its height
+        self.min_start_distance = min(self.min_trip_distance, self.grid_size[0] // 2 + self.grid_size[1] // 2)
+        if self.min_start_distance < 1:
+            raise ValueError("A grid of size {} has no room for a trip".format(self.grid_size))
         self.intersections = OrderedDict()
-        self.roads = []
         for x in xrange(self.bounds[0], self.bounds[2] + 1):
             for y in xrange(self.bounds[1], self.bounds[3] + 1):
                 self.intersections[(x, y)] = TrafficLight()  # a traffic light at each intersection
+        self.intersection_list = self.intersections.keys()  # for random choices without rebuilding the key list
 
-        for a in self.intersections:
-            for b in self.intersections:
-                if a == b:
-                    continue
-                if (abs(a[0] - b[0]) + abs(a[1] - b[1])) == 1:  # L1 distance = 1
-                    self.roads.append((a, b))
+        # Optionally replace the lights with a closed-form model that needs no per-tick updates
+        self.light_phases = None
+        if analytic_lights:
+            self.light_phases = TrafficLightPhases.from_lights(self.intersections.itervalues())
+            for index, intersection in enumerate(self.intersections):
+                self.intersections[intersection] = PhasedTrafficLight(self.light_phases, index)
+
+        self.build_road_network()
 
-        # Dummy agents
-        for i in xrange(self.num_dummies):
-            self.create_agent(DummyAgent)
+        # Outcomes of every possible move, so that act is a few table lookups
+        self.transitions = TransitionTables(self.valid_actions, self.valid_headings)
+
+        # Dummy agents, optionally simulated all at once by a vectorised kernel
+        self.traffic = None
+        if batched_traffic:
+            self.traffic = TrafficKernel(self, self.num_dummies)
+        else:
+            for i in xrange(self.num_dummies):
+                self.create_agent(DummyAgent)
 
         # Primary agent and associated parameters
         self.primary_agent = None  # to be set explicitly
         self.enforce_deadline = False
 
+    def build_road_network(self):
+        """
+        Builds the roads and the neighbor table in time linear in the number of
+        intersections. neighbors[location][i] is the (wrapped-around)
+        intersection reached by leaving location in direction valid_headings[i];
+        roads lists every pair of adjacent intersections in both directions, in
+        the same order as an all-pairs L1 distance = 1 scan would.
+        """
+        width = self.bounds[2] - self.bounds[0] + 1
+        height = self.bounds[3] - self.bounds[1] + 1
+        self.neighbors = {}
+        self.roads = []
+        for a in self.intersection_list:
+            self.neighbors[a] = [((a[0] + heading[0] - self.bounds[0]) % width + self.bounds[0],
+                                  (a[1] + heading[1] - self.bounds[1]) % height + self.bounds[1])  # wrap-around
+                                 for heading in self.valid_headings]
+            for b in ((a[0] - 1, a[1]), (a[0], a[1] - 1), (a[0], a[1] + 1), (a[0] + 1, a[1])):
+                if self.bounds[0] <= b[0] <= self.bounds[2] and self.bounds[1] <= b[1] <= self.bounds[3]:
+                    self.roads.append((a, b))
+
     def create_agent(self, agent_class, *args, **kwargs):
         agent = agent_class(self, *args, **kwargs)
-        self.agent_states[agent] = {'location': random.choice(self.intersections.keys()), 'heading': (0, 1)}
+        self.agent_order[agent] = len(self.agent_states)
+        self.agent_states[agent] = {'location': random.choice(self.intersection_list), 'heading': (0, 1)}
+        self.add_occupant(agent, self.agent_states[agent]['location'])
         return agent
 
     def set_primary_agent(self, agent, enforce_deadline=False):
@@ -79,39 +179,55 @@ class Environment(object):
         self.t = 0
 
         # Reset traffic lights
-        for traffic_light in self.intersections.itervalues():
-            traffic_light.reset()
+        if self.light_phases is not None:
+            self.light_phases.reset()
+        else:
+            for traffic_light in self.intersections.itervalues():
+                traffic_light.reset()
 
         # Pick a start and a destination
-        start = random.choice(self.intersections.keys())
-        destination = random.choice(self.intersections.keys())
+        start = random.choice(self.intersection_list)
+        destination = random.choice(self.intersection_list)
 
         # Ensure starting location and destination are not too close
-        while self.compute_dist(start, destination) < 4:
-            start = random.choice(self.intersections.keys())
-            destination = random.choice(self.intersections.keys())
+        while self.compute_dist(start, destination) < self.min_start_distance:
+            start = random.choice(self.intersection_list)
+            destination = random.choice(self.intersection_list)
 
         start_heading = random.choice(self.valid_headings)
         deadline = self.compute_dist(start, destination) * 5
-        print "Environment.reset(): Trial set up with start = {}, destination = {}, deadline = {}".format(start, destination, deadline)
+        log.emit(INFO, "Environment.reset()", "Trial set up with start = {start}, destination = {destination}, deadline = {deadline}",
+                 start=start, destination=destination, deadline=deadline)
 
         # Initialize agent(s)
+        if self.traffic is not None:
+            self.traffic.reset()
         for agent in self.agent_states.iterkeys():
             self.agent_states[agent] = {
-                'location': start if agent is self.primary_agent else random.choice(self.intersections.keys()),
+                'location': start if agent is self.primary_agent else random.choice(self.intersection_list),
                 'heading': start_heading if agent is self.primary_agent else random.choice(self.valid_headings),
                 'destination': destination if agent is self.primary_agent else None,
                 'deadline': deadline if agent is self.primary_agent else None}
             agent.reset(destination=(destination if agent is self.primary_agent else None))
 
+        # Rebuild the occupancy index; agent_states is already in creation order
+        self.occupancy = {}
+        for agent, state in self.agent_states.iteritems():
+            self.occupancy.setdefault(state['location'], []).append(agent)
+
     def step(self):
         #print "Environment.step(): t = {}".format(self.t)  # [debug]
 
         # Update traffic lights
-        for intersection, traffic_light in self.intersections.iteritems():
-            traffic_light.update(self.t)
+        if self.light_phases is not None:
+            self.light_phases.advance(self.t)
+        else:
+            for intersection, traffic_light in self.intersections.iteritems():
+                traffic_light.update(self.t)
 
         # Update agents
+        if self.traffic is not None:
+            self.traffic.step()  # the dummy cars were created first
         for agent in self.agent_states.iterkeys():
             agent.update(self.t)
 
@@ -122,34 +238,44 @@ class Environment(object):
             agent_deadline = self.agent_states[self.primary_agent]['deadline']
             if agent_deadline <= self.hard_time_limit:
                 self.done = True
-                print "Environment.step(): Primary agent hit hard time limit ({})! Trial aborted.".format(self.hard_time_limit)
+                log.emit(INFO, "Environment.step()", "Primary agent hit hard time limit ({limit})! Trial aborted.", limit=self.hard_time_limit)
             elif self.enforce_deadline and agent_deadline <= 0:
                 self.done = True
-                print "Environment.step(): Primary agent ran out of time! Trial aborted."
+                log.emit(INFO, "Environment.step()", "Primary agent ran out of time! Trial aborted.")
             self.agent_states[self.primary_agent]['deadline'] = agent_deadline - 1
 
         self.t += 1
 
+    def light_states(self):
+        """The state of every traffic light (True = NS open), in intersections order, as a boolean array."""
+        if self.light_phases is not None:
+            return self.light_phases.states_at(self.light_phases.t)
+        return np.fromiter((light.state for light in self.intersections.itervalues()), dtype=bool,
+                           count=len(self.intersections))
+
     def sense(self, agent):
         assert agent in self.agent_states, "Unknown agent!"
 
         state = self.agent_states[agent]
         location = state['location']
         heading = state['heading']
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or ((not self.intersections[location].state) and heading[0] != 0) else 'red'
+        light = self.transitions.light[self.intersections[location].state][self.transitions.heading_index[heading]]
 
-        # Populate oncoming, left, right
+        # Populate oncoming, left, right from the (heading, waypoint) of the others here, in creation order
         oncoming = None
         left = None
         right = None
-        for other_agent, other_state in self.agent_states.iteritems():
-            if agent == other_agent or location != other_state['location'] or (heading[0] == other_state['heading'][0] and heading[1] == other_state['heading'][1]):
+        others = ((self.agent_states[other_agent]['heading'], other_agent.get_next_waypoint())
+                  for other_agent in self.occupancy.get(location, ()) if other_agent is not agent)
+        if self.traffic is not None:
+            others = itertools.chain(self.traffic.cars_at(location), others)
+        for other_state_heading, other_heading in others:
+            if heading[0] == other_state_heading[0] and heading[1] == other_state_heading[1]:
                 continue
-            other_heading = other_agent.get_next_waypoint()
-            if (heading[0] * other_state['heading'][0] + heading[1] * other_state['heading'][1]) == -1:
+            if (heading[0] * other_state_heading[0] + heading[1] * other_state_heading[1]) == -1:
                 if oncoming != 'left':  # we don't want to override oncoming == 'left'
                     oncoming = other_heading
-            elif (heading[1] == other_state['heading'][0] and -heading[0] == other_state['heading'][1]):
+            elif (heading[1] == other_state_heading[0] and -heading[0] == other_state_heading[1]):
                 if right != 'forward' and right != 'left':  # we don't want to override right == 'forward or 'left'
                     right = other_heading
             else:
@@ -168,57 +294,64 @@ class Environment(object):
         state = self.agent_states[agent]
         location = state['location']
         heading = state['heading']
-        light = 'green' if (self.intersections[location].state and heading[1] != 0) or ((not self.intersections[location].state) and heading[0] != 0) else 'red'
         inputs = self.sense(agent)
 
+        # Look up the outcome of the action given the light, heading and traffic
+        transitions = self.transitions
+        phase = self.intersections[location].state
+        h = transitions.heading_index[heading]
+        a = transitions.action_index[action]
+        o = transitions.action_index[inputs['oncoming']]
+        l = transitions.action_index[inputs['left']]
+        heading, moved = transitions.moves[phase][h][a][o][l]
+        reward = transitions.rewards[phase][h][a][o][l][transitions.action_index[agent.get_next_waypoint()]]
+
         # Move agent if within bounds and obeys traffic rules
-        reward = 0  # reward/penalty
-        move_okay = True
-        if action == 'forward':
-            if light != 'green':
-                move_okay = False
-        elif action == 'left':
-            if light == 'green' and (inputs['oncoming'] == None or inputs['oncoming'] == 'left'):
-                heading = (heading[1], -heading[0])
-            else:
-                move_okay = False
-        elif action == 'right':
-            if light == 'green' or inputs['left'] != 'forward':
-                heading = (-heading[1], heading[0])
-            else:
-                move_okay = False
-
-        if move_okay:
-            # Valid move (could be null)
-            if action is not None:
-                # Valid non-null move
-                location = ((location[0] + heading[0] - self.bounds[0]) % (self.bounds[2] - self.bounds[0] + 1) + self.bounds[0],
-                            (location[1] + heading[1] - self.bounds[1]) % (self.bounds[3] - self.bounds[1] + 1) + self.bounds[1])  # wrap-around
-                #if self.bounds[0] <= location[0] <= self.bounds[2] and self.bounds[1] <= location[1] <= self.bounds[3]:  # bounded
-                state['location'] = location
-                state['heading'] = heading
-                reward = 2.0 if action == agent.get_next_waypoint() else -0.5  # valid, but is it correct? (as per waypoint)
-            else:
-                # Valid null move
-                reward = 0.0
-        else:
-            # Invalid move
-            reward = -1.0
+        if moved:
+            location = self.neighbors[location][transitions.heading_index[heading]]  # wrap-around
+            self.remove_occupant(agent, state['location'])
+            self.add_occupant(agent, location)
+            state['location'] = location
+            state['heading'] = heading
 
         if agent is self.primary_agent:
             if state['location'] == state['destination']:
                 if state['deadline'] >= 0:
                     reward += 10  # bonus
                 self.done = True
-                print "Environment.act(): Primary agent has reached destination!"  # [debug]
-            self.status_text = "state: {}\naction: {}\nreward: {}".format(agent.get_state(), action, reward)
+                log.emit(DEBUG, "Environment.act()", "Primary agent has reached destination!")
+            self.status = (agent.get_state(), action, reward)  # formatted on demand by status_text
             #print "Environment.act() [POST]: location: {}, heading: {}, action: {}, reward: {}".format(location, heading, action, reward)  # [debug]
 
         return reward
 
+    def add_occupant(self, agent, location):
+        """Adds the agent to the occupancy index, keeping each intersection's agents in creation order."""
+        occupants = self.occupancy.setdefault(location, [])
+        order = self.agent_order[agent]
+        i = len(occupants)
+        while i > 0 and self.agent_order[occupants[i - 1]] > order:
+            i -= 1
+        occupants.insert(i, agent)
+
+    def remove_occupant(self, agent, location):
+        """Removes the agent from the occupancy index."""
+        occupants = self.occupancy[location]
+        occupants.remove(agent)
+        if not occupants:
+            del self.occupancy[location]
+
+    @property
+    def status_text(self):
+        if self.status is None:
+            return ""
+        return "state: {}\naction: {}\nreward: {}".format(*self.status)
+
     def compute_dist(self, a, b):
-        """L1 distance between two points."""
-        return abs(b[0] - a[0]) + abs(b[1] - a[1])
+        """L1 distance between two points, going around the edges when that is shorter (the roads wrap around)."""
+        dx = abs(b[0] - a[0])
+        dy = abs(b[1] - a[1])
+        return min(dx, self.grid_size[0] - dx) + min(dy, self.grid_size[1] - dy)
 
 
 class Agent(object):
@@ -0,0 +1,78 @@
+import json
+import time
+from collections import deque
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+DISABLED = 100
+
+
+class ConsoleSink(object):
+    """Prints each event as a formatted line, like the original print statements."""
+
+    def write(self, record):
+        timestamp, level, source, message, fields = record
+        print "{}: {}".format(source, message.format(**fields))
+
+
+class RingBufferSink(object):
+    """Keeps the most recent records in memory."""
+
+    def __init__(self, capacity=10000):
+        self.records = deque(maxlen=capacity)
+
+    def write(self, record):
+        self.records.append(record)
+
+    def clear(self):
+        self.records.clear()
+
+
+class FileSink(object):
+    """
+    Appends one compact tab-separated line per event to a file: timestamp,
+    level, source, message template and the event's fields as JSON.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, 'a')
+
+    def write(self, record):
+        timestamp, level, source, message, fields = record
+        self.file.write("{:.6f}\t{}\t{}\t{}\t{}\n".format(
+            timestamp, level, source, message, json.dumps(fields, default=str)))
+
+    def close(self):
+        self.file.close()
+
+
+class EventLog(object):
+    """
+    Levelled, structured event log. Events below the configured level return
+    after a single comparison and are never formatted; the rest are passed to
+    the sink as (timestamp, level, source, message, fields) records, where
+    message is a str.format template for the fields.
+    """
+
+    def __init__(self, level=DEBUG, sink=None):
+        self.configure(level, sink)
+
+    def configure(self, level=DEBUG, sink=None):
+        self.level = level
+        self.sink = sink if sink is not None else ConsoleSink()
+
+    def disable(self):
+        self.level = DISABLED
+
+    def enabled_for(self, level):
+        return level >= self.level
+
+    def emit(self, level, source, message, **fields):
+        if level < self.level:
+            return
+        self.sink.write((time.time(), level, source, message, fields))
+
+
+# Shared by the whole simulation; prints everything to the console by default
+log = EventLog()
@@ -1,8 +1,247 @@
-from agent import run
+import argparse
+import errno
+import glob
+import hashlib
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import zlib
+
+from agent import run, create_simulation, LearningAgent
+from eventlog import log
+from results_store import ResultsStore
+import metrics
+
+log.disable()  # per-trial console output only slows the sweep down
 
 search_values = [0.01, 0.03, 0.05, 0.07, 0.1, 0.3, 0.5, 0.7]
+output_dir = './data/gridsearch'
+halving_output_dir = './data/halving'
+manifest_name = 'manifest.jsonl'
+
+def run_seed(alpha, gamma, epsilon, base_seed=0):
+    """
+    Deterministic RNG seed for a configuration. It only depends on the
+    parameters, so a run gives the same results whether it executes serially
+    or in any worker process of a parallel search.
+    """
+    return zlib.crc32("{}:{}:{}:{}".format(base_seed, alpha, gamma, epsilon)) & 0xffffffff
+
+
+def code_version():
+    """
+    A short hash of the simulation source code: every module of the package,
+    so that a change to any module a run imports gives a new version.
+    """
+    sha = hashlib.sha1()
+    for source in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+        with open(source, 'rb') as source_file:
+            sha.update(os.path.basename(source))
+            sha.update(source_file.read())
+    return sha.hexdigest()[:12]
+
+
+def configurations(values=search_values, base_seed=0, n_trials=100):
+    """All (alpha, gamma, epsilon, seed, n_trials) combinations of the given values."""
+    return [(alpha, gamma, epsilon, run_seed(alpha, gamma, epsilon, base_seed), n_trials)
+            for alpha, gamma, epsilon in itertools.product(values, values, values)]
+
+
+def run_configuration(configuration, results_store=None):
+    """
+    Runs a single configuration, writing its results to the alpha_<alpha>
+    subdirectory of output_dir (or appending them to the results store at the
+    given path), and returns its manifest record.
+    """
+    alpha, gamma, epsilon, seed, n_trials = configuration
+    if results_store is not None:
+        agent = run(alpha, gamma, epsilon, n_trials=n_trials, seed=seed, results_store=results_store)
+        return {'alpha': alpha, 'gamma': gamma, 'epsilon': epsilon, 'seed': seed, 'n_trials': n_trials,
+                'states': len(agent.possible_states), 'results_store': results_store, 'store_run_id': agent.store_run_id}
+
+    alpha_dir = os.path.join(output_dir, "alpha_{}".format(alpha))
+    try:
+        os.makedirs(alpha_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:  # another worker may have just created it
+            raise
+    agent = run(alpha, gamma, epsilon, n_trials=n_trials, seed=seed, output_dir=alpha_dir)
+    return {'alpha': alpha, 'gamma': gamma, 'epsilon': epsilon, 'seed': seed, 'n_trials': n_trials,
+            'states': len(agent.possible_states),
+            'trial_stats': agent.file_name('trial_stats', 'csv'), 'Q_and_N': agent.file_name('Q_and_N', 'txt')}
+
+
+def manifest_key(record):
+    # Where the results went is part of the key: a run written to files is no use to a store sweep, and vice versa
+    return (record['alpha'], record['gamma'], record['epsilon'], record['seed'], record['n_trials'],
+            record['states'], record['code_version'], record.get('results_store'))
+
+
+def load_manifest():
+    """Reads the manifest of completed runs into a dict keyed by manifest_key."""
+    manifest = {}
+    path = os.path.join(output_dir, manifest_name)
+    if os.path.exists(path):
+        with open(path) as manifest_file:
+            for line in manifest_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # a line cut short by a crash
+                manifest[manifest_key(record)] = record
+    return manifest
+
+
+def append_to_manifest(record):
+    with open(os.path.join(output_dir, manifest_name), 'a') as manifest_file:
+        manifest_file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def has_valid_results(record):
+    """
+    Whether the run's trial stats hold every trial and, for runs written to
+    files, both of the run's files exist.
+    """
+    if 'results_store' in record:
+        if not os.path.exists(record['results_store']):
+            return False
+        with ResultsStore(record['results_store']) as store:
+            return store.trials_recorded(record['store_run_id']) == record['n_trials']
+    if not (os.path.exists(record['trial_stats']) and os.path.exists(record['Q_and_N'])):
+        return False
+    with open(record['trial_stats']) as csv_file:
+        return sum(1 for line in csv_file) - 1 == record['n_trials']  # minus the header
+
+
+def run_task(task):
+    """The worker function of the pool: runs a (configuration, results store) task."""
+    return run_configuration(*task)
+
+
+def grid_search(values=search_values, processes=None, base_seed=0, n_trials=100, resume=True, results_store=None):
+    """
+    Runs every configuration in a pool of worker processes (one per core by
+    default; processes=1 runs them serially in this process) and returns the
+    manifest records of all the configurations.
+
+    Completed runs are recorded in a manifest in output_dir, keyed by the
+    parameters, seed, trial count, state space size and code version. With
+    resume, configurations that already have valid results are skipped, so an
+    interrupted sweep picks up where it stopped and extending the grid only
+    runs the new configurations.
+
+    When the path of a results store is given, every run is appended to
+    that database instead of being written to its own files.
+    """
+    try:
+        os.makedirs(output_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if results_store is not None:
+        ResultsStore(results_store).close()  # creates the database before the workers start
+    version = code_version()
+    states = len(LearningAgent(None).possible_states)
+    manifest = load_manifest() if resume else {}
+
+    records = []
+    tasks = []
+    for configuration in configurations(values, base_seed, n_trials):
+        alpha, gamma, epsilon, seed, n_trials = configuration
+        record = manifest.get((alpha, gamma, epsilon, seed, n_trials, states, version, results_store))
+        if record is not None and has_valid_results(record):
+            records.append(record)
+        else:
+            tasks.append((configuration, results_store))
+
+    if processes == 1:
+        results = itertools.imap(run_task, tasks)
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(run_task, tasks)
+    try:
+        for record in results:
+            record['code_version'] = version
+            append_to_manifest(record)  # as soon as it completes, so a crash loses nothing
+            records.append(record)
+    finally:
+        if processes != 1:
+            pool.close()
+            pool.join()
+    return records
+
+
+def successive_halving(values=search_values, base_seed=0, min_trials=20, n_trials=100, eta=3):
+    """
+    Searches the same configurations as grid_search by successive halving:
+    every configuration is run for min_trials trials, the best 1/eta of them
+    (ranked by the fitness score of the analysis, with the extrema taken over
+    the configurations in the round) carry on for eta times as many trials in
+    total, and so on until the survivors have run all n_trials. Their results
+    are written to halving_output_dir and the best configuration is returned
+    as (params, score, total trials simulated).
+
+    The survivors carry on learning where they stopped rather than starting
+    over. Each configuration keeps its own RNG state between rounds, so its
+    trials are exactly the first trials of a full run with the same seed.
+    Rounds must be at least metrics.min_scored_trials long, so that every
+    configuration has last trials to score.
+    """
+    if min(min_trials, n_trials) < metrics.min_scored_trials:
+        raise ValueError("Configurations can't be scored after fewer than {} trials".format(
+            metrics.min_scored_trials))
+    try:
+        os.makedirs(halving_output_dir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    candidates = {}  # (alpha, gamma, epsilon) -> [simulator, agent, RNG state]
+    for alpha, gamma, epsilon, seed, _ in configurations(values, base_seed, n_trials):
+        sim, agent = create_simulation(alpha, gamma, epsilon, n_trials, stream_results=False, seed=seed,
+                                       output_dir=halving_output_dir)
+        candidates[(alpha, gamma, epsilon)] = [sim, agent, random.getstate()]
+
+    trials_simulated = 0
+    budget = min(min_trials, n_trials)
+    while True:
+        raw = {}
+        for params, candidate in candidates.iteritems():
+            sim, agent, rng_state = candidate
+            random.setstate(rng_state)
+            trials = budget - agent.trials_completed
+            sim.run_headless(n_trials=trials)
+            candidate[2] = random.getstate()
+            trials_simulated += trials
+
+            df = agent.trial_stats.to_dataframe()
+            df['Trial'] = df.index
+            raw[params] = metrics.raw_scores(df)
+
+        extrema = {name: {'max': max(r[name] for r in raw.itervalues()), 'min': min(r[name] for r in raw.itervalues())}
+                   for name in metrics.metric_calculators}
+        scores = {params: metrics.fitness_score(r, extrema) for params, r in raw.iteritems()}
+        ranked = sorted(candidates, key=lambda params: scores[params], reverse=True)
+        if budget == n_trials:
+            break
+
+        candidates = {params: candidates[params] for params in ranked[:max(1, len(ranked) // eta)]}
+        budget = min(budget * eta, n_trials)
+
+    alpha, gamma, epsilon = ranked[0]
+    return {'alpha': alpha, 'gamma': gamma, 'epsilon': epsilon}, scores[ranked[0]], trials_simulated
+
 
-for alpha in search_values:
-    for gamma in search_values:
-        for epsilon in search_values:
-            run(alpha, gamma, epsilon)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Search for the optimal Q-Learning parameters.")
+    parser.add_argument('--halving', action='store_true', help="search by successive halving")
+    parser.add_argument('--store', help="append the results to this results store instead of writing files")
+    parser.add_argument('--processes', type=int, help="number of worker processes (default: one per core)")
+    args = parser.parse_args()
+    if args.halving:
+        params, score, trials = successive_halving()
+        print "The optimal parameters are: {} (fitness score {}, {} trials simulated)".format(params, score, trials)
+    else:
+        grid_search(processes=args.processes, results_store=args.store)
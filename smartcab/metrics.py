@@ -0,0 +1,112 @@
+from collections import OrderedDict
+
+import numpy as np
+
+# Fitness metrics for a simulation's trial stats DataFrame (with a Trial
+# column numbering the trials from 0). The averages over the last trials use
+# the trials numbered above 80% of the trial count: Trial > 80, the last 19
+# trials, for a 100-trial simulation, and Trial > 16, the last 3, for a
+# 20-trial one. Simulations of fewer than min_scored_trials trials have no
+# last trials to average.
+
+min_scored_trials = 6
+
+def last_trials_start(df):
+    return int(0.8 * len(df))
+
+def raw_total_reward_score_calculator(df):
+    return np.average(df[df.Trial > last_trials_start(df)].total_reward)
+
+def raw_negative_reward_score_calculator(df):
+    total_negative_reward = np.sum(df.negative_reward)
+    last_trials_with_negative_rewards = df[df.negative_reward < 0].Trial.tolist()[-2:]
+    return np.average(last_trials_with_negative_rewards) * total_negative_reward
+
+def raw_trial_length_score_calculator(df):
+    return np.average(df[df.Trial > last_trials_start(df)].trial_length)
+
+def raw_destination_score_calculator(df):
+    last_trial_failures = df[df.reached_destination == False].Trial.tolist()[-2:]
+    if len(last_trial_failures) == 0:
+        return 0
+    else:
+        return np.average(last_trial_failures)
+
+def calculate_scaled_score(score, maximum, minimum, bigger_is_better=True):
+    """
+    Scales the score on a 100 point scale where 100 is better than 0 and
+    both 100 and 0 are achieveable.
+    """
+    score = np.asarray(score, dtype=float)  # a single score or an array of scores
+    if maximum == minimum:
+        return np.full(score.shape, 100.0)  # every simulation scored the same
+
+    if bigger_is_better:
+        normalised_score = (score - minimum) / (maximum - minimum)
+    else:
+        normalised_score = (maximum - score) / (maximum - minimum)
+
+    return normalised_score * 100
+
+# (calculator, bigger_is_better) for each dimension of fitness
+metric_calculators = OrderedDict([
+    ('total_reward', (raw_total_reward_score_calculator, True)),
+    ('negative_reward', (raw_negative_reward_score_calculator, True)),
+    ('trial_length', (raw_trial_length_score_calculator, False)),
+    ('destination', (raw_destination_score_calculator, False)),
+])
+
+def raw_scores(df):
+    """The raw value of each dimension of fitness for the given DataFrame."""
+    return OrderedDict((name, calculator(df)) for name, (calculator, _) in metric_calculators.iteritems())
+
+def fitness_score(raw, extrema):
+    """
+    The average of the four dimensions of fitness, each scaled on a 100 point
+    scale. raw is a dict of raw_scores, extrema maps each dimension to a
+    {'max': ..., 'min': ...} dict taken over the simulations being compared.
+    raw may also be a raw_scores_by_simulation DataFrame, in which case an
+    array with the score of every simulation is returned.
+
+    NB: As in the original analysis, the trial length dimension scales the
+    average total reward (not the average trial length) against the trial
+    length extrema. It is kept that way so that scores remain comparable with
+    previously reported results.
+    """
+    scaled = []
+    for name, (_, bigger_is_better) in metric_calculators.iteritems():
+        score = raw['total_reward'] if name == 'trial_length' else raw[name]
+        scaled.append(calculate_scaled_score(score, extrema[name]['max'], extrema[name]['min'], bigger_is_better))
+    return np.average(scaled, axis=0)
+
+def raw_scores_by_simulation(df, by):
+    """
+    raw_scores for every simulation in a DataFrame holding the trial stats of
+    many simulations, which are identified by the columns in by. All the
+    simulations are scored in one grouped pass; the result has a row per
+    simulation and a column per dimension of fitness.
+    """
+    import pandas as pd
+    groups = df.groupby(by)
+    trials = groups.Trial.transform('size')
+    last_trials = df[df.Trial > (0.8 * trials).astype(int)].groupby(by)
+    raw = pd.DataFrame(index=groups.size().index)
+
+    raw['total_reward'] = last_trials.total_reward.mean()
+
+    negative = df[df.negative_reward < 0]
+    last_negative = negative[negative.groupby(by).cumcount(ascending=False) < 2]
+    raw['negative_reward'] = last_negative.groupby(by).Trial.mean() * groups.negative_reward.sum()
+
+    raw['trial_length'] = last_trials.trial_length.mean()
+
+    failures = df[df.reached_destination == False]
+    last_failures = failures[failures.groupby(by).cumcount(ascending=False) < 2]
+    raw['destination'] = last_failures.groupby(by).Trial.mean()
+    raw['destination'] = raw['destination'].fillna(0)  # no failures at all
+
+    return raw
+
+def extrema(raw):
+    """The {'max': ..., 'min': ...} of each dimension of fitness in a raw_scores_by_simulation DataFrame."""
+    return {name: {'max': raw[name].max(), 'min': raw[name].min()} for name in metric_calculators}
@@ -1,38 +1,132 @@
 import random
+from collections import OrderedDict
+
+import numpy as np
+
+from eventlog import log, DEBUG
+
+
+class WaypointTable(object):
+    """
+    Shortest-path waypoints on the grid, whose roads wrap around at the edges
+    (a torus), to any destination from every location and heading.
+
+    A cab moves one block per step, either straight on or after turning left
+    or right (there are no U-turns), so the shortest routes to a destination
+    are found by a breadth-first search backwards from it over (location,
+    heading) states. The waypoint for a state is the first action of a
+    shortest route, preferring forward, then right, then left when routes tie,
+    and None at the destination. Locations are in Environment.intersections
+    order and headings are indices into the given headings.
+
+    Only the moves between states are built up front (linear in the size of
+    the grid); each destination's search is run when its routes are first
+    asked for, and the most recently used destinations' waypoints are cached
+    (up to cache_bytes of them).
+    """
+
+    actions = ['forward', 'right', 'left']  # in order of preference
+    choices = actions + [None]  # indexed by waypoint codes; None (at the destination) is the last code
+
+    def __init__(self, bounds, headings, cache_bytes=2 ** 24):
+        self.bounds = bounds
+        self.headings = list(headings)
+        width = bounds[2] - bounds[0] + 1
+        height = bounds[3] - bounds[1] + 1
+        self.locations = [(x, y) for x in xrange(bounds[0], bounds[2] + 1) for y in xrange(bounds[1], bounds[3] + 1)]
+        self.location_index = {location: i for i, location in enumerate(self.locations)}
+        self.heading_index = {heading: i for i, heading in enumerate(self.headings)}
+        self.shape = (len(self.locations), len(self.headings))
+
+        # successors[state, action] -> state after the action, where state = location * headings + heading
+        xs = np.repeat(np.arange(bounds[0], bounds[2] + 1), height)
+        ys = np.tile(np.arange(bounds[1], bounds[3] + 1), width)
+        num_states = len(self.locations) * len(self.headings)
+        self.successors = np.empty((num_states, len(self.actions)), dtype=int)
+        for h, heading in enumerate(self.headings):
+            for a, action in enumerate(self.actions):
+                new_heading = heading
+                if action == 'left':
+                    new_heading = (heading[1], -heading[0])
+                elif action == 'right':
+                    new_heading = (-heading[1], heading[0])
+                new_x = (xs + new_heading[0] - bounds[0]) % width
+                new_y = (ys + new_heading[1] - bounds[1]) % height
+                self.successors[h::len(self.headings), a] = ((new_x * height + new_y) * len(self.headings)
+                                                            + self.heading_index[new_heading])
+        # Each action maps states one to one, so every state has one predecessor per action
+        self.predecessors = np.empty_like(self.successors)
+        for a in xrange(len(self.actions)):
+            self.predecessors[self.successors[:, a], a] = np.arange(num_states)
+
+        self.cache_size = max(1, cache_bytes // num_states)  # destinations whose waypoints are kept
+        self.cache = OrderedDict()  # destination index -> waypoint codes, least recently used first
+
+    def distances(self, destination):
+        """The number of moves along a shortest route to the destination (a location index) from every state."""
+        distances = np.full(self.shape[0] * self.shape[1], -1, dtype=int)
+        frontier = destination * self.shape[1] + np.arange(self.shape[1])
+        distances[frontier] = 0
+        moves = 0
+        while frontier.size:
+            moves += 1
+            frontier = np.unique(self.predecessors[frontier])
+            frontier = frontier[distances[frontier] < 0]
+            distances[frontier] = moves
+        return distances.reshape(self.shape)
+
+    def codes(self, destination):
+        """
+        The waypoints to the destination (a location index) as a (locations,
+        headings) array of indices into choices.
+        """
+        if destination in self.cache:
+            codes = self.cache.pop(destination)
+        else:
+            distances = self.distances(destination).ravel()
+            distances = np.where(distances < 0, distances.size, distances)  # unreachable
+            codes = np.argmin(distances[self.successors], axis=1).astype(np.int8).reshape(self.shape)
+            codes[destination, :] = len(self.actions)  # None
+            if len(self.cache) >= self.cache_size:
+                self.cache.popitem(last=False)
+        self.cache[destination] = codes
+        return codes
+
+    def as_codes(self, destination, actions):
+        """The waypoints to the destination (a location index) as indices into actions (e.g. Environment.valid_actions)."""
+        return np.array([actions.index(choice) for choice in self.choices], dtype=np.int8)[self.codes(destination)]
+
+
+waypoint_tables = {}  # WaypointTables by (bounds, headings), shared by every planner and environment
+
+def waypoint_table(bounds, headings):
+    key = (tuple(bounds), tuple(headings))
+    if key not in waypoint_tables:
+        waypoint_tables[key] = WaypointTable(bounds, headings)
+    return waypoint_tables[key]
+
 
 class RoutePlanner(object):
-    """Silly route planner that is meant for a perpendicular grid network."""
+    """
+    Route planner for the wrap-around grid network: each waypoint is the next
+    step along a shortest route to the destination, looked up in the grid's
+    WaypointTable.
+    """
 
     def __init__(self, env, agent):
         self.env = env
         self.agent = agent
         self.destination = None
+        self.table = None
+        self.codes = None  # codes[location index, heading index] -> waypoint, as an index into WaypointTable.choices
 
     def route_to(self, destination=None):
-        self.destination = destination if destination is not None else random.choice(self.env.intersections.keys())
-        print "RoutePlanner.route_to(): destination = {}".format(destination)  # [debug]
+        self.destination = destination if destination is not None else random.choice(self.env.intersection_list)
+        self.table = waypoint_table(self.env.bounds, self.env.valid_headings)
+        self.codes = self.table.codes(self.table.location_index[self.destination])
+        log.emit(DEBUG, "RoutePlanner.route_to()", "destination = {destination}", destination=destination)
 
     def next_waypoint(self):
-        location = self.env.agent_states[self.agent]['location']
-        heading = self.env.agent_states[self.agent]['heading']
-        delta = (self.destination[0] - location[0], self.destination[1] - location[1])
-        if delta[0] == 0 and delta[1] == 0:
-            return None
-        elif delta[0] != 0:  # EW difference
-            if delta[0] * heading[0] > 0:  # facing correct EW direction
-                return 'forward'
-            elif delta[0] * heading[0] < 0:  # facing opposite EW direction
-                return 'right'  # long U-turn
-            elif delta[0] * heading[1] > 0:
-                return 'left'
-            else:
-                return 'right'
-        elif delta[1] != 0:  # NS difference (turn logic is slightly different)
-            if delta[1] * heading[1] > 0:  # facing correct NS direction
-                return 'forward'
-            elif delta[1] * heading[1] < 0:  # facing opposite NS direction
-                return 'right'  # long U-turn
-            elif delta[1] * heading[0] > 0:
-                return 'right'
-            else:
-                return 'left'
+        state = self.env.agent_states[self.agent]
+        return self.table.choices[self.codes[self.table.location_index[state['location']],
+                                             self.table.heading_index[state['heading']]]]
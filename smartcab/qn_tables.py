@@ -0,0 +1,119 @@
+import glob
+import json
+import os
+import re
+
+import numpy as np
+
+# Runs' Q(s,a) and N(s,a) tables, as written by LearningAgent.report_data: the
+# Q_and_N text dumps and their lossless .npz sidecars.
+
+params_pattern = re.compile(r"_a:([^_]+)_g:([^_]+)_e:([^_/]+)\.txt$")
+full_exponent = re.compile(r"e[-+]\d\d+$")  # str() always writes at least two exponent digits
+params_dtype = [('alpha', float), ('gamma', float), ('epsilon', float)]
+cache_name = 'Q_and_N_cache'
+
+
+def sidecar_path(dump_path):
+    """The path of the .npz sidecar written alongside a Q_and_N text dump."""
+    return os.path.splitext(dump_path)[0] + '.npz'
+
+
+def parse_q_value(value):
+    """
+    Parses a Q value cut to 8 characters by fixed_length_string. The digits
+    beyond the 8th are lost; values whose exponent was cut off (e.g.
+    '2.75814e' or '1.234e-0') cannot be recovered at all and are returned as
+    NaN.
+    """
+    if 'e' in value and full_exponent.search(value) is None:
+        return np.nan
+    return float(value)
+
+
+def parse_table(text, parse_value):
+    """Parses one of the tables written by state_action_matrix_string into (states, actions, values)."""
+    lines = text.strip('\n').split('\n')
+    actions = [column.strip() for column in lines[0].split('|')[1:-1]]
+    rows = [line.split('|') for line in lines[1:]]
+    states = [row[0].strip() for row in rows]
+    values = [[parse_value(value.strip()) for value in row[1:-1]] for row in rows]
+    return states, actions, values
+
+
+def parse_matrices(text):
+    """
+    Parses the text of a Q_and_N dump (LearningAgent.matrices_string) into
+    (states, actions, Q, N), where Q and N are (states, actions) arrays.
+    """
+    q_text, n_text = text.split("\nN(s,a):\n")
+    states, actions, q = parse_table(q_text.split("Q(s,a):\n", 1)[1], parse_q_value)
+    _, _, n = parse_table(n_text, int)
+    return states, actions, np.array(q, dtype=np.float64), np.array(n, dtype=np.int64)
+
+
+def load_matrices(dump_path):
+    """
+    The (Q, N) tables of a run, read from the run's lossless .npz sidecar
+    when there is one and parsed from the text dump otherwise.
+    """
+    if os.path.exists(sidecar_path(dump_path)):
+        with np.load(sidecar_path(dump_path)) as sidecar:
+            return sidecar['q'], sidecar['n']
+    with open(dump_path) as dump_file:
+        _, _, q, n = parse_matrices(dump_file.read())
+    return q, n
+
+
+def sweep_files(directory):
+    """The Q_and_N dumps (named with their parameters) in directory and its subdirectories, in sorted order."""
+    paths = glob.glob(os.path.join(directory, 'Q_and_N_*.txt')) + glob.glob(os.path.join(directory, '*', 'Q_and_N_*.txt'))
+    return sorted(path for path in paths if params_pattern.search(path))
+
+
+def file_signature(path, directory):
+    """Identifies the version of a dump (and of its sidecar) for the cache."""
+    signature = [os.path.relpath(path, directory), os.path.getsize(path), os.path.getmtime(path)]
+    if os.path.exists(sidecar_path(path)):
+        signature += [os.path.getsize(sidecar_path(path)), os.path.getmtime(sidecar_path(path))]
+    return signature
+
+
+def load_sweep(directory='./data/gridsearch', cache=True):
+    """
+    Loads the Q and N tables of every run in a sweep (e.g. the grid search)
+    as (params, Q, N): Q and N are (runs, states, actions) arrays and params
+    is a structured array with the alpha, gamma and epsilon of each run.
+
+    With cache, the arrays are saved in a Q_and_N_cache subdirectory and are
+    memory-mapped from there by later loads, as long as the sweep's files
+    have not changed since. All the runs must have the same state space.
+    """
+    paths = sweep_files(directory)
+    cache_dir = os.path.join(directory, cache_name)
+    index_path = os.path.join(cache_dir, 'index.json')
+    signatures = [file_signature(path, directory) for path in paths]
+
+    if cache and os.path.exists(index_path):
+        with open(index_path) as index_file:
+            if json.load(index_file) == signatures:
+                return tuple(np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+                             for name in ('params', 'q', 'n'))
+
+    params = np.array([tuple(float(value) for value in params_pattern.search(path).groups()) for path in paths],
+                      dtype=params_dtype)
+    tables = [load_matrices(path) for path in paths]
+    if len(set(q.shape for q, _ in tables)) > 1:
+        raise ValueError("The runs in {} do not all have the same state space".format(directory))
+    q = np.array([q for q, _ in tables], dtype=np.float64)
+    n = np.array([n for _, n in tables], dtype=np.int64)
+
+    if cache:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        for name, array in (('params', params), ('q', q), ('n', n)):
+            np.save(os.path.join(cache_dir, name + '.npy'), array)
+        with open(index_path + '.tmp', 'w') as index_file:  # written last, so the cache is only used once complete
+            json.dump(signatures, index_file)
+        os.rename(index_path + '.tmp', index_path)
+    return params, q, n
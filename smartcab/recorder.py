@@ -0,0 +1,138 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
+class GrowableArray(object):
+    """A preallocated 1-D NumPy array that doubles its capacity when full (amortised O(1) appends)."""
+
+    def __init__(self, dtype=float, capacity=128):
+        self.data = np.zeros(max(1, capacity), dtype=dtype)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, value):
+        if self.size == self.data.shape[0]:
+            self.data = np.resize(self.data, 2 * self.data.shape[0])
+        self.data[self.size] = value
+        self.size += 1
+
+    @property
+    def values(self):
+        """The recorded values (a view, valid until the next append)."""
+        return self.data[:self.size]
+
+    def clear(self):
+        self.size = 0
+
+
+class TrialStatsRecorder(object):
+    """
+    Columnar store of per-trial statistics, plus optional per-step series.
+
+    Each column is a GrowableArray, so recording a trial costs a handful of
+    array writes regardless of how many trials came before; pandas is only
+    imported, and a DataFrame only built, when the data is reported. Per-step
+    series are stored as one flat array per series together with the offset
+    at which each trial's steps end.
+    """
+
+    def __init__(self, columns, dtypes=None, capacity=128, series=()):
+        self.columns = list(columns)
+        dtypes = dtypes if dtypes is not None else [float] * len(self.columns)
+        self.data = OrderedDict((c, GrowableArray(dtype, capacity)) for c, dtype in zip(self.columns, dtypes))
+        self.series = OrderedDict((name, GrowableArray(float, capacity)) for name in series)
+        self.series_ends = OrderedDict((name, GrowableArray(int, capacity)) for name in series)
+
+    def __len__(self):
+        return len(self.data[self.columns[0]])
+
+    def record(self, *values):
+        """Records one trial; values are given in column order."""
+        for column, value in zip(self.data.itervalues(), values):
+            column.append(value)
+        for name, ends in self.series_ends.iteritems():
+            ends.append(len(self.series[name]))
+
+    def record_step(self, name, value):
+        """Records one step of the current trial in the named series."""
+        self.series[name].append(value)
+
+    def column(self, name):
+        return self.data[name].values
+
+    def step_series(self, name, trial):
+        """The values recorded in the named series during the given trial."""
+        ends = self.series_ends[name].values
+        start = ends[trial - 1] if trial > 0 else 0
+        return self.series[name].values[start:ends[trial]]
+
+    def clear(self):
+        for array in self.data.values() + self.series.values() + self.series_ends.values():
+            array.clear()
+
+    def to_dataframe(self, index_offset=0):
+        import pandas as pd
+        return pd.DataFrame(OrderedDict((c, self.column(c)) for c in self.columns), columns=self.columns,
+                            index=np.arange(index_offset, index_offset + len(self)))
+
+    def to_csv(self, path):
+        self.to_dataframe().to_csv(path)
+
+
+class StreamingTrialWriter(object):
+    """
+    Streams a TrialStatsRecorder to a CSV file while a run is in progress.
+
+    Trials are appended to the file in batches, after which the recorder is
+    cleared, so memory use is bounded by the batch size and a run that is
+    killed loses at most one batch. Optionally, a text checkpoint (such as
+    the Q(s,a) and N(s,a) matrices) is rewritten every checkpoint_every
+    trials; it is written to a temporary file and renamed into place so that
+    the checkpoint on disk is always complete.
+    """
+
+    def __init__(self, recorder, csv_path, batch_size=10, checkpoint_path=None, checkpoint_every=None):
+        self.recorder = recorder
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_every = checkpoint_every
+        self.trials_written = 0
+        self.trials_recorded = 0
+        with open(self.csv_path, 'w') as csv_file:
+            csv_file.write(',' + ','.join(recorder.columns) + '\n')  # same header as DataFrame.to_csv
+
+    def trial_recorded(self, checkpoint=None):
+        """
+        To be called after each trial is added to the recorder. checkpoint is
+        a callable returning the checkpoint text; it is only called when a
+        checkpoint is due.
+        """
+        self.trials_recorded += 1
+        if len(self.recorder) >= self.batch_size:
+            self.flush()
+        if (checkpoint is not None and self.checkpoint_path is not None and self.checkpoint_every
+                and self.trials_recorded % self.checkpoint_every == 0):
+            self.write_checkpoint(checkpoint())
+
+    def flush(self):
+        """Appends the buffered trials to the CSV file and clears the recorder."""
+        if len(self.recorder) == 0:
+            return
+        with open(self.csv_path, 'a') as csv_file:
+            self.recorder.to_dataframe(index_offset=self.trials_written).to_csv(csv_file, header=False)
+        self.trials_written += len(self.recorder)
+        self.recorder.clear()
+
+    def write_checkpoint(self, text):
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as checkpoint_file:
+            checkpoint_file.write(text)
+        os.rename(temporary_path, self.checkpoint_path)
+
+    def close(self):
+        self.flush()
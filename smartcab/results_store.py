@@ -0,0 +1,154 @@
+import sqlite3
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    label TEXT,
+    alpha REAL,
+    gamma REAL,
+    epsilon REAL,
+    seed INTEGER,
+    states INTEGER,
+    actions INTEGER,
+    n_trials INTEGER,
+    created REAL
+);
+CREATE INDEX IF NOT EXISTS runs_by_parameters ON runs (alpha, gamma, epsilon);
+
+CREATE TABLE IF NOT EXISTS trial_stats (
+    run_id INTEGER REFERENCES runs,
+    trial INTEGER,
+    total_reward REAL,
+    negative_reward REAL,
+    trial_length INTEGER,
+    reached_destination INTEGER,
+    PRIMARY KEY (run_id, trial)
+);
+
+CREATE TABLE IF NOT EXISTS tables (
+    run_id INTEGER PRIMARY KEY REFERENCES runs,
+    q BLOB,
+    n BLOB
+);
+"""
+
+
+class ResultsStore(object):
+    """
+    Append-only SQLite database holding the results of many runs: each run's
+    parameters, its trial stats and its final Q(s,a) and N(s,a) tables.
+
+    Runs are indexed by their Q-Learning parameters and run id. Each run is
+    appended in a single transaction and the database uses write-ahead
+    logging, so runs in parallel processes (each with its own ResultsStore)
+    can append while others read; a writer waits up to timeout seconds for
+    the database lock. A whole sweep is read back with one query per table.
+    The Q and N tables are stored as raw float64/int64 arrays, so they are
+    lossless and load without any parsing.
+    """
+
+    trial_stats_columns = ['total_reward', 'negative_reward', 'trial_length', 'reached_destination']
+
+    def __init__(self, path, timeout=60.0):
+        self.path = path
+        self.connection = sqlite3.connect(path, timeout=timeout, isolation_level=None)  # transactions are explicit
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        with self.transaction() as connection:  # so that concurrent processes create the schema one at a time
+            for statement in SCHEMA.split(';'):
+                connection.execute(statement)
+
+    @contextmanager
+    def transaction(self):
+        self.connection.execute("BEGIN IMMEDIATE")  # take the write lock up front
+        try:
+            yield self.connection
+        except:
+            self.connection.execute("ROLLBACK")
+            raise
+        self.connection.execute("COMMIT")
+
+    def add_run(self, alpha, gamma, epsilon, trial_stats, q_table, n_table, seed=None, label=None):
+        """
+        Appends a run and returns its run id. trial_stats maps each of
+        trial_stats_columns to the values of every trial.
+        """
+        q_table = np.asarray(q_table, dtype=np.float64)
+        n_table = np.asarray(n_table, dtype=np.int64)
+        columns = [np.asarray(trial_stats[c]).tolist() for c in self.trial_stats_columns]
+        n_trials = len(columns[0])
+        with self.transaction() as connection:
+            run_id = connection.execute(
+                "INSERT INTO runs (label, alpha, gamma, epsilon, seed, states, actions, n_trials, created) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (label, alpha, gamma, epsilon, seed, q_table.shape[0], q_table.shape[1], n_trials, time.time())
+            ).lastrowid
+            connection.executemany("INSERT INTO trial_stats VALUES (?, ?, ?, ?, ?, ?)",
+                                   ((run_id, trial) + tuple(values) for trial, values in enumerate(zip(*columns))))
+            connection.execute("INSERT INTO tables VALUES (?, ?, ?)",
+                               (run_id, buffer(q_table.tobytes()), buffer(n_table.tobytes())))
+        return run_id
+
+    def trials_recorded(self, run_id):
+        """The number of trials stored for the run (0 for an unknown run)."""
+        return self.connection.execute("SELECT COUNT(*) FROM trial_stats WHERE run_id = ?", (run_id,)).fetchone()[0]
+
+    def _where(self, parameters, table='runs'):
+        if not parameters:
+            return "", ()
+        names = sorted(parameters)
+        return (" WHERE " + " AND ".join("{}.{} = ?".format(table, name) for name in names),
+                tuple(parameters[name] for name in names))
+
+    def runs(self, **parameters):
+        """A DataFrame of the runs, optionally only those with the given parameter values (e.g. alpha=0.5)."""
+        import pandas as pd
+        where, values = self._where(parameters)
+        return pd.read_sql_query("SELECT * FROM runs" + where + " ORDER BY run_id", self.connection, params=values)
+
+    def trial_stats(self, **parameters):
+        """
+        The trial stats of all the matching runs as one DataFrame, with the
+        run id, parameters and Trial number alongside the trial stats columns.
+        """
+        import pandas as pd
+        where, values = self._where(parameters)
+        df = pd.read_sql_query(
+            "SELECT runs.run_id, runs.alpha, runs.gamma, runs.epsilon, trial_stats.trial AS Trial, "
+            + ", ".join("trial_stats." + c for c in self.trial_stats_columns)
+            + " FROM trial_stats JOIN runs ON runs.run_id = trial_stats.run_id" + where
+            + " ORDER BY runs.run_id, trial_stats.trial", self.connection, params=values)
+        df['reached_destination'] = df['reached_destination'].astype(bool)
+        return df
+
+    def tables(self, **parameters):
+        """
+        The Q(s,a) and N(s,a) tables of all the matching runs as
+        (run ids, Q, N), where Q and N are (runs, states, actions) arrays.
+        All the runs must have the same state and action space.
+        """
+        where, values = self._where(parameters)
+        rows = self.connection.execute(
+            "SELECT runs.run_id, runs.states, runs.actions, tables.q, tables.n"
+            " FROM tables JOIN runs ON runs.run_id = tables.run_id" + where + " ORDER BY runs.run_id",
+            values).fetchall()
+        run_ids = np.array([row[0] for row in rows], dtype=int)
+        shape = (len(rows),) + ((rows[0][1], rows[0][2]) if rows else (0, 0))
+        q = np.empty(shape, dtype=np.float64)
+        n = np.empty(shape, dtype=np.int64)
+        for i, (run_id, states, actions, q_bytes, n_bytes) in enumerate(rows):
+            q[i] = np.frombuffer(q_bytes, dtype=np.float64).reshape(states, actions)
+            n[i] = np.frombuffer(n_bytes, dtype=np.int64).reshape(states, actions)
+        return run_ids, q, n
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -2,6 +2,18 @@ import os
 import time
 import random
 import importlib
+import threading
+from collections import namedtuple
+from Queue import Queue, Empty
+
+import numpy as np
+
+from eventlog import log, DEBUG, WARNING
+
+# Everything Simulator.draw needs, copied out of the environment: the traffic
+# light states (in env.intersections order), the cars as (color, has_sprite,
+# location, heading, waypoint, destination) tuples and the status text
+Snapshot = namedtuple('Snapshot', ['lights', 'cars', 'status_text'])
 
 class Simulator(object):
     """Simulates agents in a dynamic smartcab environment.
@@ -21,7 +33,11 @@ class Simulator(object):
         'orange'  : (255, 128,   0)
     }
 
-    def __init__(self, env, size=None, update_delay=1.0, display=True):
+    event_interval = 0.05  # longest sleep between checks for GUI events (in secs)
+    render_thread_frame_rate = 30  # default frame rate of a render thread
+
+    def __init__(self, env, size=None, update_delay=1.0, display=True, frame_rate=None, offscreen=False, capture=None,
+                 render_thread=False):
         self.env = env
         self.size = size if size is not None else ((self.env.grid_size[0] + 1) * self.env.block_size, (self.env.grid_size[1] + 1) * self.env.block_size)
         self.width, self.height = self.size
@@ -35,137 +51,424 @@ class Simulator(object):
         self.current_time = 0.0
         self.last_updated = 0.0
         self.update_delay = update_delay  # duration between each step (in secs)
+        self.frame_interval = 1.0 / frame_rate if frame_rate else max(update_delay, 0.001)  # duration between GUI frames (in secs); by default, one frame per step
+        if render_thread and not frame_rate:
+            self.frame_interval = 1.0 / self.render_thread_frame_rate
+
+        # Optionally draw in a thread of its own, from snapshots of the environment; the
+        # threads only share the snapshot and pause queues and these flags
+        self.render_thread = render_thread
+        self.snapshots = None  # Queue of at most one Snapshot, made when the render thread wants one
+        self.pauses = None  # Queue of the durations of the pauses, for the simulation to make up for
+        self.frame_wanted = threading.Event()
+        self.resumed = threading.Event()  # cleared while paused
+        self.quit_requested = threading.Event()
+        self.render_stop = threading.Event()
+        assert not (render_thread and capture is not None), "Frames can't be captured from a render thread!"
 
-        self.display = display
+        self.offscreen = offscreen  # render without a window, through SDL's dummy video driver
+        self.capture = capture  # a FrameCapture, which is given the rendered frames it wants
+        self.display = display or offscreen
         if self.display:
             try:
                 self.pygame = importlib.import_module('pygame')
-                self.pygame.init()
-                self.screen = self.pygame.display.set_mode(self.size)
-
-                self.frame_delay = max(1, int(self.update_delay * 1000))  # delay between GUI frames in ms (min: 1)
-                self.agent_sprite_size = (32, 32)
-                self.agent_circle_radius = 10  # radius of circle, when using simple representation
-                for agent in self.env.agent_states:
-                    agent._sprite = self.pygame.transform.smoothscale(self.pygame.image.load(os.path.join("images", "car-{}.png".format(agent.color))), self.agent_sprite_size)
-                    agent._sprite_size = (agent._sprite.get_width(), agent._sprite.get_height())
-
-                self.font = self.pygame.font.Font(None, 28)
-                self.paused = False
+                if not self.render_thread:
+                    self.init_display()  # otherwise the render thread sets up the display it draws on
             except ImportError as e:
                 self.display = False
-                print "Simulator.__init__(): Unable to import pygame; display disabled.\n{}: {}".format(e.__class__.__name__, e)
+                log.emit(WARNING, "Simulator.__init__()", "Unable to import pygame; display disabled.\n{error_type}: {error}",
+                         error_type=e.__class__.__name__, error=e)
             except Exception as e:
                 self.display = False
-                print "Simulator.__init__(): Error initializing GUI objects; display disabled.\n{}: {}".format(e.__class__.__name__, e)
+                log.emit(WARNING, "Simulator.__init__()", "Error initializing GUI objects; display disabled.\n{error_type}: {error}",
+                         error_type=e.__class__.__name__, error=e)
+        if self.capture is not None and not self.display:
+            log.emit(WARNING, "Simulator.__init__()", "No display to capture frames from; capture disabled.")
+            self.capture = None
+
+    def init_display(self):
+        # pygame has a single display per process, on the video driver that SDL_VIDEODRIVER named when it was
+        # initialized: offscreen, the dummy driver is selected for this display only
+        previous_driver = os.environ.get('SDL_VIDEODRIVER')
+        if self.offscreen:
+            os.environ['SDL_VIDEODRIVER'] = 'dummy'
+        try:
+            wants_dummy = self.offscreen or previous_driver == 'dummy'
+            if self.pygame.display.get_init() and (self.pygame.display.get_driver() == 'dummy') != wants_dummy:
+                self.pygame.display.quit()  # e.g. left on the dummy driver by an offscreen simulator
+            self.pygame.init()
+            self.screen = self.pygame.display.set_mode(self.size)
+        finally:
+            if previous_driver is None:
+                os.environ.pop('SDL_VIDEODRIVER', None)
+            else:
+                os.environ['SDL_VIDEODRIVER'] = previous_driver
+
+        self.frame_delay = max(1, int(self.update_delay * 1000))  # delay between GUI frames in ms (min: 1)
+        self.agent_sprite_size = (32, 32)
+        self.agent_circle_radius = 10  # radius of circle, when using simple representation
+        self.car_sprites = {}  # color -> {heading: sprite}, rotated once when loaded
+        for agent in self.env.agent_states:
+            agent._sprites = self.load_sprites(agent.color)
+        if self.env.traffic is not None:
+            for color in set(self.env.traffic.colors):
+                self.load_sprites(color)
+
+        self.font = self.pygame.font.Font(None, 28)
+        self.text_surfaces = {}  # (text, color, background) -> rendered text
+        self.background = self.draw_background()
+        self.scene = None  # background with the traffic lights drawn on
+        self.scene_lights = None  # light states drawn on scene
+        self.paused = False
 
     def run(self, n_trials=1):
+        if self.render_thread and self.display:
+            self.run_with_render_thread(n_trials)
+            return
+        if (not self.display or self.offscreen) and self.update_delay == 0:
+            self.run_headless(n_trials=n_trials)  # nothing to pace, and only captured frames to draw
+            return
+
         self.quit = False
         for trial in xrange(n_trials):
-            print "Simulator.run(): Trial {}".format(trial)  # [debug]
+            log.emit(DEBUG, "Simulator.run()", "Trial {trial}", trial=trial)
             self.env.reset()
+            self.start_trial_capture()
             self.current_time = 0.0
             self.last_updated = 0.0
             self.start_time = time.time()
-            while True:
-                try:
+            next_step = self.update_delay  # deadlines, in secs since start_time (which is moved forward by pauses)
+            next_frame = 0.0
+            steps = 0  # taken in this trial
+            try:
+                while not (self.quit or self.env.done):
                     # Update current time
                     self.current_time = time.time() - self.start_time
-                    #print "Simulator.run(): current_time = {:.3f}".format(self.current_time)
 
                     # Handle GUI events
                     if self.display:
-                        for event in self.pygame.event.get():
-                            if event.type == self.pygame.QUIT:
-                                self.quit = True
-                            elif event.type == self.pygame.KEYDOWN:
-                                if event.key == 27:  # Esc
-                                    self.quit = True
-                                elif event.unicode == u' ':
-                                    self.paused = True
-
+                        if self.handle_events():
+                            self.quit = True
                         if self.paused:
-                            self.pause()
+                            self.start_time += self.pause()
+                            continue
 
-                    # Update environment
-                    if self.current_time - self.last_updated >= self.update_delay:
+                    # Update environment: take every step that is due, however late (frames are dropped instead)
+                    drawn = False  # whether the capture has already rendered the current state
+                    while not self.env.done and self.current_time >= next_step:
                         self.env.step()
+                        steps += 1
+                        drawn = self.capture_frame(steps)
                         self.last_updated = self.current_time
+                        next_step += self.update_delay
+                        if self.update_delay == 0:
+                            break  # no schedule to keep up with, so one step per pass
 
-                    # Render GUI and sleep
-                    if self.display:
-                        self.render()
-                        self.pygame.time.wait(self.frame_delay)
-                except KeyboardInterrupt:
-                    self.quit = True
-                finally:
-                    if self.quit or self.env.done:
-                        break
+                    # Render GUI, skipping any frames that are overdue
+                    if self.display and (self.current_time >= next_frame or self.env.done):
+                        if not drawn:
+                            self.render()
+                        next_frame += self.frame_interval
+                        if next_frame <= self.current_time:
+                            next_frame = self.current_time + self.frame_interval
+
+                    # Sleep until the next deadline
+                    if not self.env.done:
+                        deadline = next_step
+                        if self.display:
+                            deadline = min(deadline, next_frame, self.current_time + self.event_interval)
+                        delay = deadline - (time.time() - self.start_time)
+                        if delay > 0:
+                            time.sleep(delay)
+            except KeyboardInterrupt:
+                self.quit = True
 
             if self.quit:
                 break
 
+    def run_with_render_thread(self, n_trials=1):
+        """
+        Runs the simulation in this thread, unthrottled by the display (but
+        still paced by update_delay): a render thread, which owns the pygame
+        window, draws the latest snapshot of the environment at up to
+        frame_interval and handles the GUI events. The simulation only takes
+        a snapshot when the render thread is ready to draw it, and the render
+        thread signals pausing and quitting through the resumed and
+        quit_requested events, and hands back the duration of each pause, by
+        which this thread moves its deadlines. (Some platforms, e.g. macOS,
+        only support windows in the main thread.)
+        """
+        self.quit = False
+        self.snapshots = Queue(maxsize=1)
+        self.pauses = Queue()
+        self.frame_wanted.clear()
+        self.resumed.set()
+        self.quit_requested.clear()
+        self.render_stop.clear()
+        renderer = threading.Thread(target=self.render_frames, name="Simulator renderer")
+        renderer.daemon = True
+        renderer.start()
+        try:
+            for trial in xrange(n_trials):
+                log.emit(DEBUG, "Simulator.run()", "Trial {trial}", trial=trial)
+                self.env.reset()
+                self.start_time = time.time()
+                next_step = self.update_delay  # deadlines, in secs since start_time (which is moved forward by pauses)
+                while not self.env.done:
+                    if self.quit_requested.is_set():
+                        self.quit = True
+                        break
+                    if not self.resumed.is_set():
+                        self.resumed.wait(self.event_interval)
+                        continue
+                    try:
+                        self.start_time += self.pauses.get_nowait()
+                    except Empty:
+                        pass
+                    if self.update_delay > 0:
+                        delay = self.start_time + next_step - time.time()
+                        if delay > 0:
+                            time.sleep(min(delay, self.event_interval))
+                            continue
+                        next_step += self.update_delay
+
+                    self.env.step()
+                    if self.frame_wanted.is_set():
+                        self.frame_wanted.clear()
+                        self.snapshots.put(self.snapshot())
+                if self.quit:
+                    break
+        except KeyboardInterrupt:
+            self.quit = True
+        finally:
+            self.render_stop.set()
+            renderer.join()
+
+    def render_frames(self):
+        """The render thread of run_with_render_thread."""
+        try:
+            self.init_display()
+        except Exception as e:
+            log.emit(WARNING, "Simulator.render_frames()", "Error initializing GUI objects; display disabled.\n{error_type}: {error}",
+                     error_type=e.__class__.__name__, error=e)
+            return
+        self.frame_wanted.set()
+        next_frame = time.time()
+        while not self.render_stop.is_set():
+            if self.handle_events():
+                self.quit_requested.set()
+            if self.paused:
+                self.resumed.clear()
+                self.pauses.put(self.pause())
+                self.resumed.set()
+
+            try:
+                snapshot = self.snapshots.get(timeout=self.event_interval)
+            except Empty:
+                continue
+            self.draw(snapshot)
+
+            # Wait for the next frame, skipping any that are overdue
+            next_frame = max(next_frame + self.frame_interval, time.time())
+            delay = next_frame - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self.frame_wanted.set()
+
+    def handle_events(self):
+        """Handles the pending GUI events: returns whether quitting was asked for, and sets paused."""
+        quit = False
+        for event in self.pygame.event.get():
+            if event.type == self.pygame.QUIT:
+                quit = True
+            elif event.type == self.pygame.KEYDOWN:
+                if event.key == 27:  # Esc
+                    quit = True
+                elif event.unicode == u' ':
+                    self.paused = True
+        return quit
+
+    def run_headless(self, n_trials=None, max_steps=None):
+        """
+        Runs the environment as fast as possible, without drawing or keeping
+        time (frames are only rendered for the capture, if there is one):
+        trials are stepped back to back until n_trials trials have
+        finished or max_steps steps have been taken in total (whichever comes
+        first; at least one of them must be given). Returns the aggregate
+        results as a dict: the number of trials finished, the number of
+        steps taken, the number of trials in which the primary agent reached
+        its destination and the elapsed wall-clock time in seconds.
+        """
+        assert n_trials is not None or max_steps is not None, "Either n_trials or max_steps is needed!"
+        env = self.env
+        step = env.step
+        steps_left = max_steps if max_steps is not None else float('inf')
+        results = {'trials': 0, 'steps': 0, 'successes': 0, 'elapsed': 0.0}
+
+        self.quit = False
+        start_time = time.time()
+        try:
+            while (n_trials is None or results['trials'] < n_trials) and steps_left > 0:
+                log.emit(DEBUG, "Simulator.run_headless()", "Trial {trial}", trial=results['trials'])
+                env.reset()
+                t = 0
+                if self.capture is None:
+                    while not env.done and t < steps_left:
+                        step()
+                        t += 1
+                else:
+                    self.start_trial_capture()
+                    while not env.done and t < steps_left:
+                        step()
+                        t += 1
+                        self.capture_frame(t)
+                results['steps'] += t
+                steps_left -= t
+                if not env.done:
+                    break  # out of steps in the middle of the trial
+                results['trials'] += 1
+                if env.primary_agent is not None:
+                    state = env.agent_states[env.primary_agent]
+                    results['successes'] += state['location'] == state['destination']
+        except KeyboardInterrupt:
+            self.quit = True
+        results['elapsed'] = time.time() - start_time
+        return results
+
+    def load_sprites(self, color):
+        """The car sprite of the given color, pre-rotated for each heading."""
+        if color not in self.car_sprites:
+            sprite = self.pygame.transform.smoothscale(self.pygame.image.load(os.path.join("images", "car-{}.png".format(color))), self.agent_sprite_size)
+            self.car_sprites[color] = {heading: sprite if heading == (1, 0) else self.pygame.transform.rotate(sprite, 180 if heading[0] == -1 else heading[1] * -90)
+                                       for heading in self.env.valid_headings}
+        return self.car_sprites[color]
+
+    def text_surface(self, text, color, background):
+        """The text rendered with the font, reused for as long as the same text is drawn."""
+        key = (text, color, background)
+        if key not in self.text_surfaces:
+            if len(self.text_surfaces) >= 256:
+                self.text_surfaces.clear()  # e.g. old status lines
+            self.text_surfaces[key] = self.font.render(text, True, color, background)
+        return self.text_surfaces[key]
+
+    def draw_background(self):
+        """Draws the static elements (roads and intersections) once, onto a surface of their own."""
+        background = self.pygame.Surface(self.size).convert()
+        background.fill(self.bg_color)
+        for road in self.env.roads:
+            self.pygame.draw.line(background, self.road_color, (road[0][0] * self.env.block_size, road[0][1] * self.env.block_size), (road[1][0] * self.env.block_size, road[1][1] * self.env.block_size), self.road_width)
+        for intersection in self.env.intersections:
+            self.pygame.draw.circle(background, self.road_color, (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size), 10)
+        return background
+
+    def start_trial_capture(self):
+        if self.capture is not None:
+            self.capture.start_trial()
+            self.capture_frame(0)
+
+    def capture_frame(self, step):
+        """
+        Renders the current state for the capture, if it wants the frame after
+        the given step of the trial, and returns whether it did. (Steps are
+        counted here, as env.t is not advanced by the step in which the
+        primary agent arrives.)
+        """
+        if self.capture is not None and self.capture.wants(step, self.env.done):
+            self.render()
+            self.capture.add_frame(self.screen, step)
+            return True
+        return False
+
     def render(self):
-        # Clear screen
-        self.screen.fill(self.bg_color)
+        self.draw(self.snapshot())
+
+    def snapshot(self):
+        """Copies the state of the environment that draw shows into a Snapshot."""
+        cars = []
+        if self.env.traffic is not None:
+            traffic = self.env.traffic
+            for i in xrange(traffic.num_cars):
+                cars.append((traffic.colors[i], True, traffic.locations[traffic.location[i]],
+                             traffic.headings[traffic.heading[i]], traffic.actions[traffic.waypoint[i]], None))
+        for agent, state in self.env.agent_states.iteritems():
+            cars.append((agent.color, hasattr(agent, '_sprites'), state['location'], state['heading'],
+                         agent.get_next_waypoint(), state['destination']))
+        return Snapshot(self.env.light_states(), tuple(cars), self.env.status_text)
 
+    def draw(self, snapshot):
         # Draw elements
-        # * Static elements
-        for road in self.env.roads:
-            self.pygame.draw.line(self.screen, self.road_color, (road[0][0] * self.env.block_size, road[0][1] * self.env.block_size), (road[1][0] * self.env.block_size, road[1][1] * self.env.block_size), self.road_width)
-
-        for intersection, traffic_light in self.env.intersections.iteritems():
-            self.pygame.draw.circle(self.screen, self.road_color, (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size), 10)
-            if traffic_light.state:  # North-South is open
-                self.pygame.draw.line(self.screen, self.colors['green'],
-                    (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size - 15),
-                    (intersection[0] * self.env.block_size, intersection[1] * self.env.block_size + 15), self.road_width)
-            else:  # East-West is open
-                self.pygame.draw.line(self.screen, self.colors['green'],
-                    (intersection[0] * self.env.block_size - 15, intersection[1] * self.env.block_size),
-                    (intersection[0] * self.env.block_size + 15, intersection[1] * self.env.block_size), self.road_width)
+        # * Static elements, and the traffic lights on top (only the lights that changed are redrawn)
+        if self.scene is None:
+            self.scene = self.background.copy()
+            changed = xrange(len(snapshot.lights))
+        else:
+            changed = np.flatnonzero(snapshot.lights != self.scene_lights)
+        for index in changed:
+            self.draw_light(self.env.intersection_list[index], snapshot.lights[index])
+        self.scene_lights = snapshot.lights
+        self.screen.blit(self.scene, (0, 0))  # also clears the screen
 
         # * Dynamic elements
-        for agent, state in self.env.agent_states.iteritems():
-            # Compute precise agent location here (back from the intersection some)
-            agent_offset = (2 * state['heading'][0] * self.agent_circle_radius, 2 * state['heading'][1] * self.agent_circle_radius)
-            agent_pos = (state['location'][0] * self.env.block_size - agent_offset[0], state['location'][1] * self.env.block_size - agent_offset[1])
-            agent_color = self.colors[agent.color]
-            if hasattr(agent, '_sprite') and agent._sprite is not None:
-                # Draw agent sprite (image), properly rotated
-                rotated_sprite = agent._sprite if state['heading'] == (1, 0) else self.pygame.transform.rotate(agent._sprite, 180 if state['heading'][0] == -1 else state['heading'][1] * -90)
-                self.screen.blit(rotated_sprite,
-                    self.pygame.rect.Rect(agent_pos[0] - agent._sprite_size[0] / 2, agent_pos[1] - agent._sprite_size[1] / 2,
-                        agent._sprite_size[0], agent._sprite_size[1]))
-            else:
-                # Draw simple agent (circle with a short line segment poking out to indicate heading)
-                self.pygame.draw.circle(self.screen, agent_color, agent_pos, self.agent_circle_radius)
-                self.pygame.draw.line(self.screen, agent_color, agent_pos, state['location'], self.road_width)
-            if agent.get_next_waypoint() is not None:
-                self.screen.blit(self.font.render(agent.get_next_waypoint(), True, agent_color, self.bg_color), (agent_pos[0] + 10, agent_pos[1] + 10))
-            if state['destination'] is not None:
-                self.pygame.draw.circle(self.screen, agent_color, (state['destination'][0] * self.env.block_size, state['destination'][1] * self.env.block_size), 6)
-                self.pygame.draw.circle(self.screen, agent_color, (state['destination'][0] * self.env.block_size, state['destination'][1] * self.env.block_size), 15, 2)
+        for color, has_sprite, location, heading, waypoint, destination in snapshot.cars:
+            car_color = self.colors[color]
+            self.draw_car(self.car_sprites.get(color) if has_sprite else None, car_color, location, heading, waypoint)
+            if destination is not None:
+                self.pygame.draw.circle(self.screen, car_color, (destination[0] * self.env.block_size, destination[1] * self.env.block_size), 6)
+                self.pygame.draw.circle(self.screen, car_color, (destination[0] * self.env.block_size, destination[1] * self.env.block_size), 15, 2)
 
         # * Overlays
         text_y = 10
-        for text in self.env.status_text.split('\n'):
-            self.screen.blit(self.font.render(text, True, self.colors['red'], self.bg_color), (100, text_y))
+        for text in snapshot.status_text.split('\n'):
+            self.screen.blit(self.text_surface(text, self.colors['red'], self.bg_color), (100, text_y))
             text_y += 20
 
         # Flip buffers
         self.pygame.display.flip()
 
+    def draw_light(self, intersection, state):
+        """Draws a traffic light onto the scene, over the background of its intersection."""
+        x, y = intersection[0] * self.env.block_size, intersection[1] * self.env.block_size
+        reach = 15 + self.road_width
+        area = self.pygame.Rect(x - reach, y - reach, 2 * reach + 1, 2 * reach + 1)
+        self.scene.blit(self.background, area, area)  # erases the light's previous state
+        if state:  # North-South is open
+            self.pygame.draw.line(self.scene, self.colors['green'], (x, y - 15), (x, y + 15), self.road_width)
+        else:  # East-West is open
+            self.pygame.draw.line(self.scene, self.colors['green'], (x - 15, y), (x + 15, y), self.road_width)
+
+    def draw_car(self, sprites, color, location, heading, waypoint):
+        # Compute precise car location here (back from the intersection some)
+        offset = (2 * heading[0] * self.agent_circle_radius, 2 * heading[1] * self.agent_circle_radius)
+        pos = (location[0] * self.env.block_size - offset[0], location[1] * self.env.block_size - offset[1])
+        if sprites is not None:
+            # Draw car sprite (image), pre-rotated to the heading
+            sprite = sprites[heading]
+            self.screen.blit(sprite,
+                self.pygame.rect.Rect(pos[0] - sprite.get_width() / 2, pos[1] - sprite.get_height() / 2,
+                    sprite.get_width(), sprite.get_height()))
+        else:
+            # Draw simple car (circle with a short line segment poking out to indicate heading)
+            self.pygame.draw.circle(self.screen, color, pos, self.agent_circle_radius)
+            self.pygame.draw.line(self.screen, color, pos, location, self.road_width)
+        if waypoint is not None:
+            self.screen.blit(self.text_surface(waypoint, color, self.bg_color), (pos[0] + 10, pos[1] + 10))
+
     def pause(self):
+        """
+        Waits for a key to be pressed (or for the render thread to be stopped)
+        and returns how long the simulation was paused, for the caller to move
+        start_time forward by.
+        """
         abs_pause_time = time.time()
         pause_text = "[PAUSED] Press any key to continue..."
-        self.screen.blit(self.font.render(pause_text, True, self.colors['cyan'], self.bg_color), (100, self.height - 40))
+        self.screen.blit(self.text_surface(pause_text, self.colors['cyan'], self.bg_color), (100, self.height - 40))
         self.pygame.display.flip()
-        print pause_text  # [debug]
-        while self.paused:
+        log.emit(DEBUG, "Simulator.pause()", pause_text)
+        while self.paused and not self.render_stop.is_set():
             for event in self.pygame.event.get():
                 if event.type == self.pygame.KEYDOWN:
                     self.paused = False
             self.pygame.time.wait(self.frame_delay)
-        self.screen.blit(self.font.render(pause_text, True, self.bg_color, self.bg_color), (100, self.height - 40))
-        self.start_time += (time.time() - abs_pause_time)
+        self.screen.blit(self.text_surface(pause_text, self.bg_color, self.bg_color), (100, self.height - 40))
+        return time.time() - abs_pause_time
@@ -0,0 +1,107 @@
+import random
+
+import numpy as np
+
+
+class TrafficKernel(object):
+    """
+    Dummy traffic stored as a struct of arrays and advanced by one vectorised
+    kernel per step, in place of one DummyAgent object per car.
+
+    Each car's intersection, heading and waypoint are held in parallel arrays
+    (locations are indices into env.intersection_list, headings into
+    env.valid_headings and waypoints into env.valid_actions). On every step
+    all the cars follow DummyAgent.update's right-of-way rules at once: they
+    sense the traffic at their intersection as it was at the start of the
+    step, including the environment's own agents, and the cars that may go
+    move. Unlike a sequence of DummyAgent updates, a car does not see the
+    moves made earlier in the same step by cars created before it.
+
+    The cars count as created before any of the environment's agents, so
+    they are stepped first and come first when an agent senses them.
+    """
+
+    color_choices = ['blue', 'cyan', 'magenta', 'orange']  # as DummyAgent
+
+    def __init__(self, env, num_cars):
+        self.env = env
+        self.num_cars = num_cars
+        self.random = np.random.RandomState(random.getrandbits(32))  # reproducible under random.seed
+
+        self.actions = list(env.valid_actions)
+        self.headings = list(env.valid_headings)
+        self.locations = list(env.intersection_list)
+        self.location_index = {location: i for i, location in enumerate(self.locations)}
+        self.none, self.forward, self.left, self.right = [self.actions.index(a) for a in (None, 'forward', 'left', 'right')]
+        self.waypoint_choices = np.array([self.forward, self.left, self.right])
+
+        heading_index = {heading: i for i, heading in enumerate(self.headings)}
+        turned = {None: lambda h: h, 'forward': lambda h: h, 'left': lambda h: (h[1], -h[0]), 'right': lambda h: (-h[1], h[0])}
+        self.turn = np.array([[heading_index[turned[a](h)] for a in self.actions] for h in self.headings])  # [heading, action]
+        self.neighbors = np.array([[self.location_index[n] for n in env.neighbors[location]] for location in self.locations])
+        self.light_green = np.array([[light == 'green' for light in phase] for phase in env.transitions.light])  # [phase, heading]
+
+        # Struct of arrays, one element per car
+        self.location = self.random.randint(len(self.locations), size=num_cars)
+        self.heading = np.full(num_cars, heading_index[(0, 1)], dtype=int)
+        self.waypoint = self.random.choice(self.waypoint_choices, size=num_cars)
+        self.colors = [self.color_choices[i] for i in self.random.randint(len(self.color_choices), size=num_cars)]
+
+    def reset(self):
+        """Places the cars at random intersections with random headings; their waypoints are kept."""
+        self.location = self.random.randint(len(self.locations), size=self.num_cars)
+        self.heading = self.random.randint(len(self.headings), size=self.num_cars)
+
+    def step(self):
+        """Advances every car by one step."""
+        # All the vehicles on the grid, the cars first and then the environment's agents
+        agent_states = self.env.agent_states.values()
+        locations = np.append(self.location, np.array([self.location_index[s['location']] for s in agent_states],
+                                                      dtype=int))
+        headings = np.append(self.heading, np.array([self.headings.index(s['heading']) for s in agent_states],
+                                                    dtype=int))
+        waypoints = np.append(self.waypoint, np.array([self.actions.index(a.get_next_waypoint())
+                                                       for a in self.env.agent_states], dtype=int))
+        oncoming, left, right = self.sense(locations, headings, waypoints)
+
+        green = self.light_green[self.env.light_states()[self.location].astype(int), self.heading]
+        okay = np.where(self.waypoint == self.right, green | (left != self.forward),
+               np.where(self.waypoint == self.forward, green,
+                        green & (oncoming != self.forward) & (oncoming != self.right)))  # left
+
+        moving = np.flatnonzero(okay)
+        self.heading[moving] = self.turn[self.heading[moving], self.waypoint[moving]]
+        self.location[moving] = self.neighbors[self.location[moving], self.heading[moving]]
+        self.waypoint[moving] = self.random.choice(self.waypoint_choices, size=len(moving))
+
+    def sense(self, locations, headings, waypoints):
+        """
+        The oncoming, left and right inputs of every car, given all the
+        vehicles' locations, headings and waypoints in creation order.
+        Vehicles are grouped by (intersection, heading); the input from a
+        group is the waypoint that Environment.sense ends up with when it
+        visits the group's vehicles in order: the first one that may not be
+        overridden, if any, otherwise the last one.
+        """
+        groups = locations * len(self.headings) + headings
+        num_groups = len(self.locations) * len(self.headings)
+        last = np.full(num_groups, -1, dtype=int)
+        present, reversed_index = np.unique(groups[::-1], return_index=True)
+        last[present] = len(groups) - 1 - reversed_index
+
+        def resolve(relation, sticky):
+            first_sticky = np.full(num_groups, -1, dtype=int)
+            candidates = np.flatnonzero(np.in1d(waypoints, sticky))
+            present, index = np.unique(groups[candidates], return_index=True)
+            first_sticky[present] = candidates[index]
+            other = self.location * len(self.headings) + (self.heading + relation) % len(self.headings)
+            chosen = np.where(first_sticky[other] >= 0, first_sticky[other], last[other])
+            return np.where(chosen >= 0, waypoints[chosen], self.none)
+
+        # Environment.sense doesn't override oncoming == 'left', right == 'forward' or 'left', or left == 'forward'
+        return (resolve(2, [self.left]), resolve(3, [self.forward]), resolve(1, [self.forward, self.left]))
+
+    def cars_at(self, location):
+        """The (heading, waypoint) of each car at the location, in creation order."""
+        return [(self.headings[self.heading[i]], self.actions[self.waypoint[i]])
+                for i in np.flatnonzero(self.location == self.location_index[location])]
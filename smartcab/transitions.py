@@ -0,0 +1,89 @@
+import numpy as np
+
+
+class TransitionTables(object):
+    """
+    Precomputed outcomes of every move an agent can make at an intersection.
+
+    Everything Environment.act decides (light colour, legality, new heading
+    and reward) depends only on the light phase, the agent's heading, the
+    action, the sensed oncoming and left inputs, and the agent's waypoint. The
+    tables enumerate all of those combinations once, so that acting becomes a
+    handful of indexed lookups. The nested lists are indexed by:
+
+        light phase  -- the TrafficLight state (False = EW open, True = NS open)
+        heading      -- index into headings
+        action, oncoming, left, waypoint -- indices into actions
+    """
+
+    def __init__(self, actions, headings):
+        self.actions = list(actions)
+        self.headings = list(headings)
+        self.action_index = {action: i for i, action in enumerate(self.actions)}
+        self.heading_index = {heading: i for i, heading in enumerate(self.headings)}
+
+        self.light = []  # [phase][heading] -> 'green' or 'red'
+        self.moves = []  # [phase][heading][action][oncoming][left] -> (new heading, moved)
+        self.rewards = []  # [phase][heading][action][oncoming][left][waypoint] -> reward
+        for ns_open in (False, True):
+            self.light.append([])
+            self.moves.append([])
+            self.rewards.append([])
+            for heading in self.headings:
+                light = 'green' if (ns_open and heading[1] != 0) or ((not ns_open) and heading[0] != 0) else 'red'
+                self.light[-1].append(light)
+                self.moves[-1].append([[[self.move(light, heading, action, oncoming, left)
+                                         for left in self.actions]
+                                        for oncoming in self.actions]
+                                       for action in self.actions])
+                self.rewards[-1].append([[[[self.reward(light, action, oncoming, left, waypoint)
+                                            for waypoint in self.actions]
+                                           for left in self.actions]
+                                          for oncoming in self.actions]
+                                         for action in self.actions])
+
+    def move_okay(self, light, action, oncoming, left):
+        """Whether the action obeys the traffic rules."""
+        if action == 'forward':
+            return light == 'green'
+        elif action == 'left':
+            return light == 'green' and (oncoming == None or oncoming == 'left')
+        elif action == 'right':
+            return light == 'green' or left != 'forward'
+        return True
+
+    def move(self, light, heading, action, oncoming, left):
+        """The agent's heading after the action and whether it leaves the intersection."""
+        if not self.move_okay(light, action, oncoming, left) or action is None:
+            return heading, False
+        if action == 'left':
+            heading = (heading[1], -heading[0])
+        elif action == 'right':
+            heading = (-heading[1], heading[0])
+        return heading, True
+
+    def reward(self, light, action, oncoming, left, waypoint):
+        if not self.move_okay(light, action, oncoming, left):
+            return -1.0  # invalid move
+        if action is None:
+            return 0.0  # valid null move
+        return 2.0 if action == waypoint else -0.5  # valid, but is it correct? (as per waypoint)
+
+    def as_arrays(self):
+        """
+        The same tables as NumPy arrays for vectorised simulators, with the
+        light phase as a 0/1 index and headings as indices into headings.
+        """
+        shape = (2, len(self.headings)) + (len(self.actions),) * 3
+        next_heading = np.zeros(shape, dtype=int)
+        moved = np.zeros(shape, dtype=bool)
+        for index in np.ndindex(*shape):
+            phase, h, a, o, l = index
+            heading, moved[index] = self.moves[phase][h][a][o][l]
+            next_heading[index] = self.heading_index[heading]
+        return {
+            'light_green': np.array([[light == 'green' for light in phase] for phase in self.light]),
+            'next_heading': next_heading,
+            'moved': moved,
+            'reward': np.array(self.rewards, dtype=float),
+        }
@@ -1,8 +1,12 @@
 import glob
+import re
+from cStringIO import StringIO
 import pandas as pd
 import numpy as np
 from IPython.display import display
 import seaborn as sns
+from smartcab import metrics
+from smartcab.results_store import ResultsStore
 
 search_values = [0.01, 0.03, 0.05, 0.07, 0.1, 0.3, 0.5, 0.7]
 
@@ -75,58 +79,54 @@ def display_stats_for_the_q_learning_agent_with_params(value):
     print "This agent received a fitness score of {}.".format(results['score'])
     display_trial_stats(df, "Q-Learning Agent: a, g, and e set to {}".format(value), -20, 70)
 
-def calculate_scaled_score(score, maximum, minimum, bigger_is_better=True):
+grid_search_parameters = ['alpha', 'gamma', 'epsilon']
+grid_search_file_pattern = re.compile(r"_a:([^_]+)_g:([^_]+)_e:([^_]+)\.csv$")
+grid_search_results_store = None  # path of a ResultsStore to read the grid search from instead of the CSV files
+
+grid_search_memo = {}
+def load_grid_search_df():
     """
-    Scales the score on a 100 point scale where 100 is better than 0 and
-    both 100 and 0 are achieveable.
+    Reads the trial stats of every simulation in the grid search into a single
+    DataFrame, with alpha, gamma and epsilon columns identifying the
+    simulation. The CSV files are globbed once and each is read once (the
+    first file found for each combination of parameters, as with load_df);
+    from a results store the whole grid search is read in one query.
     """
-    if bigger_is_better:
-        normalised_score = (float(score) - minimum) / (maximum - minimum)
-    else:
-        normalised_score = (maximum - float(score)) / (maximum - minimum)
-
-    return normalised_score * 100
-
-grid_search_extrema_memo = {}
-def grid_search_value_extrema(memo_key, operation):
-    if memo_key in grid_search_extrema_memo:
-        return grid_search_extrema_memo[memo_key]
-    min_val = 10000
-    max_val = -10000
-
-    for a in search_values:
-        for g in search_values:
-            for e in search_values:
-                file_name_pattern = "./data/gridsearch/alpha_{}/*_g:{}_e:{}.csv".format(a, g, e)
-                df = load_df(file_name_pattern)
-                if not df.empty:
-                    val = operation(df)
-                    if val > max_val:
-                        max_val = val
-                    if val < min_val:
-                        min_val = val
-
-    extrama = {'max': max_val, 'min': min_val}
-    grid_search_extrema_memo[memo_key] = extrama
-    return extrama
-
-def raw_total_reward_score_calculator(df):
-    return np.average(df[df.Trial > 80].total_reward)
-
-def raw_negative_reward_score_calculator(df):
-    total_negative_reward = np.sum(df.negative_reward)
-    last_trials_with_negative_rewards = df[df.negative_reward < 0].Trial.tolist()[-2:]
-    return np.average(last_trials_with_negative_rewards) * total_negative_reward
-
-def raw_trial_length_score_calculator(df):
-    return np.average(df[df.Trial > 80].trial_length)
-
-def raw_destination_score_calculator(df):
-    last_trial_failures = df[df.reached_destination == False].Trial.tolist()[-2:]
-    if len(last_trial_failures) == 0:
-        return 0
+    if 'df' in grid_search_memo:
+        return grid_search_memo['df']
+
+    if grid_search_results_store is not None:
+        with ResultsStore(grid_search_results_store) as store:
+            df = store.trial_stats()
+        first_runs = df.groupby(grid_search_parameters).run_id.transform('min')
+        df = df[df.run_id == first_runs].drop('run_id', axis=1)
     else:
-        return np.average(last_trial_failures)
+        # The rows of every file, prefixed with the file's parameters, are
+        # parsed by a single read_csv call
+        header = None
+        rows = []
+        found = set()
+        for file_name in glob.glob("./data/gridsearch/alpha_*/*.csv"):
+            match = grid_search_file_pattern.search(file_name)
+            if match is None or match.groups() in found:
+                continue
+            found.add(match.groups())
+            with open(file_name) as csv_file:
+                header = csv_file.readline()
+                prefix = ",".join(match.groups()) + ","
+                rows.extend(prefix + line for line in csv_file)
+        columns = ",".join(grid_search_parameters + ['Trial']) + header  # the header starts with the unnamed index column
+        df = pd.read_csv(StringIO(columns + "".join(rows)))
+
+    in_grid = np.logical_and.reduce([df[name].isin(search_values) for name in grid_search_parameters])
+    grid_search_memo['df'] = df[in_grid]
+    return grid_search_memo['df']
+
+def grid_search_raw_scores():
+    """The raw value of each dimension of fitness for every simulation in the grid search."""
+    if 'raw' not in grid_search_memo:
+        grid_search_memo['raw'] = metrics.raw_scores_by_simulation(load_grid_search_df(), grid_search_parameters)
+    return grid_search_memo['raw']
 
 def fitness_score(df):
     """
@@ -135,23 +135,7 @@ def fitness_score(df):
     negative rewards, trial length, and trials where the destination was reached).
     The fitness score is the average of the four individual scores.
     """
-    raw_total_reward_score = raw_total_reward_score_calculator(df)
-    total_reward_extrema = grid_search_value_extrema('avg_total_reward', raw_total_reward_score_calculator)
-    total_reward_score = calculate_scaled_score(raw_total_reward_score, total_reward_extrema['max'], total_reward_extrema['min'])
-
-    raw_negative_reward_score = raw_negative_reward_score_calculator(df)
-    negative_reward_extrema = grid_search_value_extrema('avg_last_negative_rewards', raw_negative_reward_score_calculator)
-    negative_reward_score = calculate_scaled_score(raw_negative_reward_score, negative_reward_extrema['max'], negative_reward_extrema['min'])
-
-    raw_trial_length_score = raw_total_reward_score_calculator(df)
-    trial_length_extrema = grid_search_value_extrema('avg_trial_length', raw_trial_length_score_calculator)
-    trial_length_score = calculate_scaled_score(raw_trial_length_score, trial_length_extrema['max'], trial_length_extrema['min'], False)
-
-    raw_destination_score = raw_destination_score_calculator(df)
-    destination_extrema = grid_search_value_extrema('avg_last_trial_failures', raw_destination_score_calculator)
-    destination_score = calculate_scaled_score(raw_destination_score, destination_extrema['max'], destination_extrema['min'], False)
-
-    return np.average([total_reward_score, negative_reward_score, trial_length_score, destination_score])
+    return metrics.fitness_score(metrics.raw_scores(df), metrics.extrema(grid_search_raw_scores()))
 
 scored_results_memo = {}
 def score_grid_search_results():
@@ -161,22 +145,22 @@ def score_grid_search_results():
     """
     if len(scored_results_memo) > 0: return scored_results_memo
 
-    for a in search_values:
-        for g in search_values:
-            for e in search_values:
-                file_name_pattern = "./data/gridsearch/alpha_{}/*_g:{}_e:{}.csv".format(a, g, e)
-                df = load_df(file_name_pattern)
-                if not df.empty:
-                    key = "a:{},g:{},e:{}".format(a, g, e)
-                    scored_results_memo[key] = {
-                            'df': df,
-                            'score': fitness_score(df),
-                            'params': {
-                                'alpha': a,
-                                'gamma': g,
-                                'epsilon': e,
-                            }
-                        }
+    df = load_grid_search_df()
+    trial_stats = df[[c for c in df.columns if c not in grid_search_parameters]]
+    rows = df.groupby(grid_search_parameters).indices  # each simulation's trials are contiguous
+    raw = grid_search_raw_scores()
+    scores = metrics.fitness_score(raw, metrics.extrema(raw))
+    for (a, g, e), score in zip(raw.index, scores):
+        simulation_rows = rows[(a, g, e)]
+        scored_results_memo["a:{},g:{},e:{}".format(a, g, e)] = {
+                'df': trial_stats.iloc[simulation_rows[0]:simulation_rows[-1] + 1].reset_index(drop=True),
+                'score': score,
+                'params': {
+                    'alpha': a,
+                    'gamma': g,
+                    'epsilon': e,
+                }
+            }
 
     return scored_results_memo
 